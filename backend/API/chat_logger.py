@@ -0,0 +1,205 @@
+import os
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from bson import ObjectId, json_util
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+import telemetry
+from concurrency import run_blocking
+
+SESSION_WINDOW = timedelta(minutes=60)
+EPOCH = datetime(1970, 1, 1)
+FLUSH_BATCH_SIZE = int(os.environ.get("CHAT_FLUSH_BATCH_SIZE", 100))
+FLUSH_INTERVAL = float(os.environ.get("CHAT_FLUSH_INTERVAL", 0.25))
+FLUSH_RETRIES = 3
+# Batches that still fail after the retries are appended here and queued again when a worker starts
+DEAD_LETTER_PATH = os.environ.get("CHAT_DEAD_LETTER_PATH", "chat_dead_letter.jsonl")
+# Users whose current session is remembered, a forgotten one is looked up again on the next message
+SESSION_CACHE_SIZE = int(os.environ.get("CHAT_SESSION_CACHE_SIZE", 10000))
+
+logger = telemetry.get_logger("chat_logger")
+
+
+class ChatLogger:
+    def __init__(self, collection_factory) -> None:
+        self._collection_factory = collection_factory
+        self.collection = None
+        self.sessions = OrderedDict()
+        self.flushed = 0
+        self.dropped = 0
+        self.dead_lettered = 0
+        self._locks = OrderedDict()
+        self._queue = None
+        self._task = None
+
+    def start(self):
+        self.collection = self._collection_factory()
+        self._queue = asyncio.Queue()
+        self._requeue_dead_letters()
+        self._task = asyncio.create_task(self._run())
+
+    def _requeue_dead_letters(self):
+        # Renaming the file first lets exactly one worker claim it, the message ids keep a replay from duplicating
+        if not DEAD_LETTER_PATH:
+            return
+        claimed = f"{DEAD_LETTER_PATH}.{os.getpid()}"
+        try:
+            os.rename(DEAD_LETTER_PATH, claimed)
+        except FileNotFoundError:
+            return
+        requeued = 0
+        with open(claimed) as f:
+            for line in f:
+                try:
+                    item = json_util.loads(line)
+                except ValueError:
+                    # A worker killed mid-write leaves a partial last line
+                    continue
+                self._queue.put_nowait((item["username"], item["session"], item["message"]))
+                requeued += 1
+        os.remove(claimed)
+        logger.warning("requeued %s chat messages from %s", requeued, DEAD_LETTER_PATH)
+
+    def _write_dead_letters(self, batch):
+        with open(DEAD_LETTER_PATH, "a") as f:
+            for username, session, message in batch:
+                f.write(json_util.dumps({"username": username, "session": session, "message": message}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def _latest_session(self, username: str, now: datetime):
+        # Reuse the user's session from the last hour, whichever worker opened it
+        projection = {"session_id": 1, "started_at": 1}
+        session = await self.collection.find_one(
+            {"username": username, "started_at": {"$gte": now - SESSION_WINDOW}},
+            sort=[("started_at", -1)],
+            projection=projection,
+        )
+        if session is not None:
+            return {"session_id": session["session_id"], "started_at": session["started_at"], "created": False}
+
+        # Otherwise open the session of the current window, the unique (username, window) index
+        # makes workers racing here all get the same one
+        session_id = ObjectId()
+        window = (now - EPOCH) // SESSION_WINDOW
+        try:
+            session = await self.collection.find_one_and_update(
+                {"username": username, "window": window},
+                {"$setOnInsert": {"session_id": session_id, "started_at": now, "messages": []}},
+                projection=projection,
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            session = await self.collection.find_one({"username": username, "window": window}, projection=projection)
+        return {"session_id": session["session_id"], "started_at": session["started_at"], "created": session["session_id"] == session_id}
+
+    def _lock(self, username: str) -> asyncio.Lock:
+        lock = self._locks.get(username)
+        if lock is None:
+            lock = self._locks[username] = asyncio.Lock()
+        self._locks.move_to_end(username)
+        # Least recently used users go first, never one whose lock is held or awaited
+        for name in list(self._locks)[:max(0, len(self._locks) - SESSION_CACHE_SIZE)]:
+            if not self._locks[name].locked():
+                del self._locks[name]
+                self.sessions.pop(name, None)
+        return lock
+
+    async def log(self, username: str, role: str, chat: str, new_chat: bool = False) -> str:
+        now = datetime.utcnow()
+        # The id makes a retried flush skip messages an earlier attempt already pushed
+        message = {"id": ObjectId(), "role": role, "chat": chat, "timestamp": now}
+
+        # Serializes session selection per user within this worker only, other workers
+        # rely on the unique window key in _latest_session
+        async with self._lock(username):
+            session = self.sessions.get(username)
+            if new_chat:
+                session = {"session_id": ObjectId(), "started_at": now, "created": True}
+                status = "New chat session created"
+            elif session is None or now - session["started_at"] > SESSION_WINDOW:
+                session = await self._latest_session(username, now)
+                status = "New session created" if session["created"] else "Message added to existing session"
+            else:
+                status = "Message added to existing session"
+            self.sessions[username] = session
+
+        self._queue.put_nowait((username, session, message))
+        return status
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + FLUSH_INTERVAL
+        while len(batch) < FLUSH_BATCH_SIZE and batch[-1] is not None:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _flush(self, batch):
+        grouped = {}
+        for username, session, message in batch:
+            key = session["session_id"]
+            if key not in grouped:
+                grouped[key] = (username, session, [])
+            grouped[key][2].append(message)
+
+        requests = []
+        for username, session, messages in grouped.values():
+            requests.append(UpdateOne(
+                {"session_id": session["session_id"]},
+                {"$setOnInsert": {"username": username, "started_at": session["started_at"], "messages": []}},
+                upsert=True,
+            ))
+            # Each push is all or nothing, after a partial failure the retry skips the pushes that landed
+            requests.append(UpdateOne(
+                {"session_id": session["session_id"], "messages.id": {"$nin": [message["id"] for message in messages]}},
+                {"$push": {"messages": {"$each": messages}}},
+            ))
+
+        for attempt in range(FLUSH_RETRIES):
+            try:
+                # Ordered, so a session exists before its push
+                await self.collection.bulk_write(requests, ordered=True)
+                self.flushed += len(batch)
+                return
+            except Exception as e:
+                logger.warning("chat log flush failed (%s/%s): %s", attempt + 1, FLUSH_RETRIES, e)
+                await asyncio.sleep(0.5 * (attempt + 1))
+
+        session_ids = sorted(str(session_id) for session_id in grouped)
+        if DEAD_LETTER_PATH:
+            try:
+                await run_blocking(self._write_dead_letters, batch)
+                self.dead_lettered += len(batch)
+                logger.error("chat log flush gave up, %s messages for sessions %s kept in %s", len(batch), session_ids, DEAD_LETTER_PATH)
+                return
+            except OSError:
+                logger.exception("could not write %s", DEAD_LETTER_PATH)
+        self.dropped += len(batch)
+        logger.error("chat log flush gave up, dropped %s messages for sessions %s", len(batch), session_ids)
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            closing = batch[-1] is None
+            batch = [item for item in batch if item is not None]
+            if batch:
+                await self._flush(batch)
+            if closing:
+                return
+
+    async def close(self):
+        if self._task is None:
+            return
+        # The sentinel is queued behind every pending message, so they all get flushed
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
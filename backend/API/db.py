@@ -1,16 +1,21 @@
-from pymongo.mongo_client import MongoClient
-from pymongo.server_api import ServerApi
+import os
 
-uri = "mongodb+srv://<username>:<password>@datainfo.nqxv2sl.mongodb.net/?retryWrites=true&w=majority&appName=DataInfo"
+from mongo import MongoManager
 
-client = MongoClient(uri, server_api=ServerApi('1'))
+# No fallback, a worker without MONGO_URI should fail at startup rather than on the first request
+mongo = MongoManager(os.environ["MONGO_URI"])
 
-try:
-    client.admin.command('ping')
-    print("Pinged your deployment. You successfully connected to MongoDB!")
-except Exception as e:
-    print(e)
-
-db = client.auth_db
+db = mongo.client.auth_db
 users_collection = db.users
-history_collection= db.history
\ No newline at end of file
+history_collection= db.history
+
+def ensure_indexes():
+    history_collection.create_index([("username", 1), ("started_at", -1), ("session_id", -1)])
+    history_collection.create_index("session_id", unique=True)
+    # One automatically opened session per user and window, sessions from explicit new chats have no window
+    history_collection.create_index(
+        [("username", 1), ("window", 1)],
+        unique=True,
+        partialFilterExpression={"window": {"$exists": True}},
+    )
+    users_collection.create_index("username")
@@ -1,79 +1,125 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query
 from fastapi.responses import JSONResponse
-from datetime import datetime, timedelta
+from datetime import datetime
+from typing import Optional
 from bson import ObjectId
-from db import history_collection
+from db import mongo
+from chat_logger import ChatLogger
 from model import ChatRequest
 
 router = APIRouter()
 
-@router.post("/save_chat/")
-async def save_chat(data: ChatRequest):
-    now = datetime.utcnow()
+def history_collection():
+    # Motor, so reads do not block the event loop
+    return mongo.async_client.auth_db.history
+
 
-    message = {
-        "role": data.role,
-        "chat": data.chat,
-        "timestamp": now
-    }
+chat_logger = ChatLogger(history_collection)
 
+@router.post("/save_chat/")
+async def save_chat(data: ChatRequest):
     try:
-        if data.new_chat:
-            new_session = {
-                "username": data.username,
-                "session_id": ObjectId(),
-                "started_at": now,
-                "messages": [message]
-            }
-            history_collection.insert_one(new_session)
-            return {"status": "success", "message": "New chat session created"}
-
-        latest_session = history_collection.find_one(
-            {"username": data.username},
-            sort=[("started_at", -1)]
-        )
-
-        if not latest_session or (now - latest_session["started_at"]) > timedelta(minutes=60):
-            new_session = {
-                "username": data.username,
-                "session_id": ObjectId(),
-                "started_at": now,
-                "messages": [message]
-            }
-            history_collection.insert_one(new_session)
-            return {"status": "success", "message": "New session created"}
-
-        history_collection.update_one(
-            {"_id": latest_session["_id"]},
-            {"$push": {"messages": message}}
-        )
-        return {"status": "success", "message": "Message added to existing session"}
+        status = await chat_logger.log(data.username, data.role, data.chat, data.new_chat)
+        return {"status": "success", "message": status}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@router.get("/sessions/{username}")
-async def get_user_sessions(username: str):
+def serialize(value):
+    if isinstance(value, dict):
+        return {key: serialize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [serialize(item) for item in value]
+    if isinstance(value, (ObjectId, datetime)):
+        return str(value)
+    return value
+
+
+def encode_cursor(session):
+    return f"{session['started_at'].isoformat()}_{session['session_id']}"
+
+
+def decode_cursor(cursor: str):
     try:
-        sessions = list(history_collection.find(
-            {"username": username},
-            {"_id": 0, "session_id": 1, "started_at": 1, "messages": 1}
-        ).sort("started_at", -1))
+        started_at, session_id = cursor.rsplit("_", 1)
+        return datetime.fromisoformat(started_at), ObjectId(session_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
 
-        if not sessions:
-            raise HTTPException(status_code=404, detail="No sessions found for this user.")
 
-        for session in sessions:
-            session["session_id"] = str(session["session_id"])
-            if "messages" in session and session["messages"]:
-                session["messages"][0]["timestamp"] = str(session["messages"][0]["timestamp"])
-            session["started_at"] = str(session["started_at"])
+@router.get("/sessions/{username}")
+async def get_user_sessions(
+    username: str,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    summary: bool = False,
+):
+    try:
+        match = {"username": username}
+        if cursor:
+            started_at, session_id = decode_cursor(cursor)
+            match["$or"] = [
+                {"started_at": {"$lt": started_at}},
+                {"started_at": started_at, "session_id": {"$lt": session_id}},
+            ]
+
+        if summary:
+            project = {"_id": 0, "session_id": 1, "started_at": 1, "message_count": {"$size": {"$ifNull": ["$messages", []]}}}
+        else:
+            project = {"_id": 0, "session_id": 1, "started_at": 1, "messages": 1}
+
+        sessions = await history_collection().aggregate([
+            {"$match": match},
+            {"$sort": {"started_at": -1, "session_id": -1}},
+            {"$limit": limit + 1},
+            {"$project": project},
+        ]).to_list(length=limit + 1)
+
+        if not sessions and not cursor:
+            raise HTTPException(status_code=404, detail="No sessions found for this user.")
 
-        return {"sessions": sessions}
+        next_cursor = encode_cursor(sessions[limit - 1]) if len(sessions) > limit else None
+        return {"sessions": serialize(sessions[:limit]), "next_cursor": next_cursor}
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/sessions/{username}/{session_id}/messages")
+async def get_session_messages(
+    username: str,
+    session_id: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=200),
+):
+    if not ObjectId.is_valid(session_id):
+        raise HTTPException(status_code=400, detail="Invalid session id.")
+
+    try:
+        # One round trip returns the page and the total count
+        messages = {"$ifNull": ["$messages", []]}
+        sessions = await history_collection().aggregate([
+            {"$match": {"username": username, "session_id": ObjectId(session_id)}},
+            {"$project": {
+                "_id": 0,
+                "session_id": 1,
+                "started_at": 1,
+                "messages": {"$slice": [messages, offset, limit]},
+                "message_count": {"$size": messages},
+            }},
+        ]).to_list(length=1)
+        if not sessions:
+            raise HTTPException(status_code=404, detail="Session not found.")
+
+        session = sessions[0]
+        count = session.pop("message_count")
+        next_offset = offset + limit if offset + limit < count else None
+        return {**serialize(session), "message_count": count, "next_offset": next_offset}
 
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
@@ -1,9 +1,31 @@
+import os
+import sys
+
+# mongo, telemetry and lifecycle are shared with the backend one directory up, every import below may use them
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
 from auth.routes import router as auth_router
-from history import router as chat_router
+from history import router as chat_router, chat_logger
+from db import mongo, ensure_indexes
+import telemetry
+from lifecycle import Lifecycle
+
+lifecycle = Lifecycle("history")
+
+@asynccontextmanager
+async def lifespan(app):
+    chat_logger.start()
+    lifecycle.start([("indexes", ensure_indexes)])
+    yield
+    await lifecycle.stop()
+    await chat_logger.close()
+    mongo.close()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.state.lifecycle = lifecycle
 origins = [
     "*"
 ]
@@ -15,9 +37,20 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+
+telemetry.instrument(app, "history")
+lifecycle.routes(app)
+telemetry.metrics.gauge("mongo_pool_checked_out", "Connections currently checked out", lambda: mongo.stats()["checked_out"])
+telemetry.metrics.gauge("mongo_pool_wait_seconds_total", "Time spent waiting for a pooled connection", lambda: mongo.stats()["wait_seconds_total"], kind="counter")
+telemetry.metrics.gauge("chat_log_messages_total", "Chat messages written, set aside or dropped by the write-behind logger", lambda: {"flushed": chat_logger.flushed, "dead_lettered": chat_logger.dead_lettered, "dropped": chat_logger.dropped}, ["result"], kind="counter")
+
 @app.get("/")
 async def root():
     return {"message": "API CREATED BY D (TEAM Techvocates)"}
 
+@app.get("/health/mongo")
+def mongo_health():
+    return {"ok": mongo.ping(), "pool": mongo.stats()}
+
 app.include_router(auth_router, prefix="/auth")
 app.include_router(chat_router, prefix="/chat")
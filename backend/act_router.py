@@ -0,0 +1,104 @@
+import os
+import threading
+from typing import Any, Callable, Dict, List
+
+from llama_index.core import Settings
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.schema import QueryBundle
+
+import streaming
+import telemetry
+from lexical import identifiers, is_lexical
+from registry import registry
+from retrieval import normalize
+
+ACT_ROUTER_THRESHOLD = float(os.environ.get("ACT_ROUTER_THRESHOLD", 0.75))
+ACT_ROUTER_MARGIN = float(os.environ.get("ACT_ROUTER_MARGIN", 0.03))
+ACT_ROUTER_CENTROID_WEIGHT = float(os.environ.get("ACT_ROUTER_CENTROID_WEIGHT", 0.5))
+
+logger = telemetry.get_logger("act_router")
+
+
+class ActRouter:
+    def __init__(self, acts: Dict[str, str], descriptions: Dict[str, str], threshold: float = ACT_ROUTER_THRESHOLD, margin: float = ACT_ROUTER_MARGIN, centroid_weight: float = ACT_ROUTER_CENTROID_WEIGHT) -> None:
+        # acts maps a tool name to its registry index, descriptions a tool name to the tool description
+        self.acts = acts
+        self.names = list(acts)
+        self.descriptions = descriptions
+        self.threshold = threshold
+        self.margin = margin
+        self.centroid_weight = centroid_weight
+        self._description_matrix = None
+        self._centroids = None
+        self._versions = None
+        self._lock = threading.Lock()
+
+    def profiles(self):
+        versions = tuple(registry.version(name) for name in self.acts.values())
+        with self._lock:
+            if self._description_matrix is None:
+                embeddings = Settings.embed_model.get_text_embedding_batch([self.descriptions[name] for name in self.names])
+                self._description_matrix = normalize(embeddings)
+            if self._centroids is None or self._versions != versions:
+                # Mean direction of every chunk in the act, kept current with the registry
+                self._centroids = normalize([registry.matrix(self.acts[name]).matrix.mean(axis=0) for name in self.names])
+                self._versions = versions
+            return self._description_matrix, self._centroids
+
+    def scores(self, embedding) -> Dict[str, float]:
+        descriptions, centroids = self.profiles()
+        query = normalize(embedding)[0]
+        scores = (1 - self.centroid_weight) * (descriptions @ query) + self.centroid_weight * (centroids @ query)
+        return dict(zip(self.names, scores.tolist()))
+
+    def lexical_route(self, query: str) -> List[str]:
+        # Identifier queries whose numbers only one act contains go there without an embedding call,
+        # "section 14" matches most acts and is routed by embedding instead
+        if not is_lexical(query):
+            return []
+        numbers = " ".join(identifiers(query))
+        names = [name for name in self.names if registry.matrix(self.acts[name]).lexical_hits(numbers, 1) is not None]
+        return names if len(names) == 1 else []
+
+    def route(self, embedding) -> List[str]:
+        # Acts scoring within the margin of the best one, empty when no act clears the threshold
+        scores = self.scores(embedding)
+        best = max(scores.values())
+        if best < self.threshold:
+            return []
+        return [name for name in sorted(scores, key=scores.get, reverse=True) if scores[name] >= best - self.margin]
+
+
+class RoutedQueryEngine(BaseQueryEngine):
+    def __init__(self, router: ActRouter, engines: Dict[str, BaseQueryEngine], fan_out: Callable[[List[str]], BaseQueryEngine], **kwargs: Any) -> None:
+        self._router = router
+        self._engines = engines
+        self._fan_out = fan_out
+        super().__init__(callback_manager=kwargs.get("callback_manager") or Settings.callback_manager)
+
+    def _get_prompt_modules(self):
+        return {}
+
+    def _engine(self, names: List[str]) -> BaseQueryEngine:
+        streaming.emit("acts", names)
+        logger.debug("routed to %s", names or "all acts")
+        if len(names) == 1:
+            return self._engines[names[0]]
+        # Cross-act or unclear questions still get sub-question decomposition
+        return self._fan_out(names or list(self._engines))
+
+    def _query(self, query_bundle: QueryBundle):
+        names = self._router.lexical_route(query_bundle.query_str) if query_bundle.embedding is None else []
+        if not names:
+            if query_bundle.embedding is None:
+                query_bundle.embedding = Settings.embed_model.get_query_embedding(query_bundle.query_str)
+            names = self._router.route(query_bundle.embedding)
+        return self._engine(names).query(query_bundle)
+
+    async def _aquery(self, query_bundle: QueryBundle):
+        names = self._router.lexical_route(query_bundle.query_str) if query_bundle.embedding is None else []
+        if not names:
+            if query_bundle.embedding is None:
+                query_bundle.embedding = await Settings.embed_model.aget_query_embedding(query_bundle.query_str)
+            names = self._router.route(query_bundle.embedding)
+        return await self._engine(names).aquery(query_bundle)
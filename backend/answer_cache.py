@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+
+import citations
+from embed_cache import normalize_text
+
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", 24 * 60 * 60))
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", 2048))
+
+
+def mode_namespace(endpoint: str, direct: bool, rewrite: bool) -> str:
+    # Agent and direct answers to the same question differ, the rewrite only applies in direct mode
+    if not direct:
+        return f"{endpoint}:agent"
+    return f"{endpoint}:direct:{'rewrite' if rewrite else 'verbatim'}"
+
+
+class _Namespace:
+    def __init__(self, capacity: int, dim: int) -> None:
+        self.matrix = np.zeros((capacity, dim), dtype=np.float32)
+        self.expires = np.zeros(capacity, dtype=np.float64)
+        self.queries = [None] * capacity
+        self.fingerprints = [None] * capacity
+        self.answers = [None] * capacity
+        self.lru = OrderedDict()
+
+    def free_slot(self) -> int:
+        if len(self.lru) < len(self.answers):
+            return len(self.lru)
+        slot, _ = self.lru.popitem(last=False)
+        return slot
+
+
+class SemanticCache:
+    def __init__(self, threshold: float = ANSWER_CACHE_THRESHOLD, ttl: float = ANSWER_CACHE_TTL, capacity: int = ANSWER_CACHE_SIZE) -> None:
+        self.threshold = threshold
+        self.ttl = ttl
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._namespaces = {}
+        # Identifier queries like "section 185" are cached by text, they are never embedded
+        self._exact = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _normalize(self, embedding):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def _get_exact(self, key):
+        entry = self._exact.get(key)
+        if entry is None or entry[0] < time.time():
+            self.misses += 1
+            return None
+        self._exact.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def get(self, namespace: str, query: str, embedding):
+        if embedding is None:
+            with self._lock:
+                return self._get_exact((namespace, normalize_text(query)))
+        embedding = self._normalize(embedding)
+        # "section 184 MVA" and "section 185 MVA" embed almost identically, only a matching citation may hit
+        fingerprint = citations.fingerprint(query)
+        with self._lock:
+            space = self._namespaces.get(namespace)
+            if space is None or not space.lru:
+                self.misses += 1
+                return None
+
+            scores = space.matrix @ embedding
+            scores[space.expires < time.time()] = -np.inf
+            scores[[other != fingerprint for other in space.fingerprints]] = -np.inf
+            slot = int(np.argmax(scores))
+            if scores[slot] < self.threshold:
+                self.misses += 1
+                return None
+
+            space.lru.move_to_end(slot)
+            self.hits += 1
+            return space.answers[slot]
+
+    def put(self, namespace: str, query: str, embedding, answer):
+        if embedding is None:
+            with self._lock:
+                key = (namespace, normalize_text(query))
+                self._exact[key] = (time.time() + self.ttl, answer)
+                self._exact.move_to_end(key)
+                while len(self._exact) > self.capacity:
+                    self._exact.popitem(last=False)
+            return
+        embedding = self._normalize(embedding)
+        fingerprint = citations.fingerprint(query)
+        with self._lock:
+            space = self._namespaces.get(namespace)
+            if space is None:
+                space = _Namespace(self.capacity, embedding.shape[0])
+                self._namespaces[namespace] = space
+
+            slot = space.free_slot()
+            space.matrix[slot] = embedding
+            space.expires[slot] = time.time() + self.ttl
+            space.queries[slot] = query
+            space.fingerprints[slot] = fingerprint
+            space.answers[slot] = answer
+            space.lru[slot] = None
+            space.lru.move_to_end(slot)
+
+    def invalidate(self, namespace: str = None):
+        with self._lock:
+            if namespace is None:
+                self._namespaces.clear()
+                self._exact.clear()
+                return
+            # "chat" covers every mode namespace of the endpoint
+            def matches(name):
+                return name == namespace or name.startswith(namespace + ":")
+            for name in [name for name in self._namespaces if matches(name)]:
+                del self._namespaces[name]
+            for key in [key for key in self._exact if matches(key[0])]:
+                del self._exact[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": {name: len(space.lru) for name, space in self._namespaces.items()},
+            "exact_entries": len(self._exact),
+        }
+
+
+answer_cache = SemanticCache()
@@ -1,13 +1,103 @@
-from fastapi import FastAPI, Request
+from fastapi import Depends, FastAPI, HTTPException, Request
 from pydantic import BaseModel
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
+import gc
+import os
 import re
-from qa import RAG
-from doc_gen import preprocessing
-from bail import Reckoner
+from functools import partial
+from typing import List, Optional
+from concurrency import run_blocking
+from lifecycle import Lifecycle
+from singleflight import SingleFlight
+import json
+import telemetry
 
-app = FastAPI()
+# LangChain, LlamaIndex, faiss and Gemini load inside the warm-up steps below,
+# importing this module stays cheap and does not need any credentials
+
+DIRECT_MODE = os.environ.get("DIRECT_MODE", "0") == "1"
+# With gunicorn --preload the master loads the indexes once and forked workers share them copy-on-write
+PRELOAD = os.environ.get("PRELOAD", "0") == "1"
+
+logger = telemetry.get_logger("api")
+
+lifecycle = Lifecycle("api")
+
+# Identical requests in flight at the same time share one run of the pipeline
+request_flight = SingleFlight("request")
+
+def preload():
+    # Loads index files only. Importing utils builds the embedding cache and model clients, which open
+    # their sqlite file and connections on first use, so each forked worker gets its own
+    from registry import registry
+    from statutes import statute_lookup
+    registry.preload()
+    statute_lookup.preload()
+
+def export_stats():
+    from answer_cache import answer_cache
+    from llama_index.core import Settings
+    from mongo import mongo
+
+    def embedding_cache_lookups():
+        cache = Settings.embed_model.cache
+        return {"memory_hit": cache.memory_hits, "disk_hit": cache.disk_hits, "miss": cache.misses}
+
+    telemetry.metrics.gauge("mongo_pool_checked_out", "Connections currently checked out", lambda: mongo.stats()["checked_out"])
+    telemetry.metrics.gauge("mongo_pool_wait_seconds_total", "Time spent waiting for a pooled connection", lambda: mongo.stats()["wait_seconds_total"], kind="counter")
+    telemetry.metrics.gauge("answer_cache_lookups_total", "Answer cache lookups", lambda: {"hit": answer_cache.hits, "miss": answer_cache.misses}, ["result"], kind="counter")
+    telemetry.metrics.gauge("embedding_cache_lookups_total", "Embedding cache lookups", embedding_cache_lookups, ["result"], kind="counter")
+
+def load_indexes():
+    from answer_cache import answer_cache
+    from registry import registry, DOC_ACTS
+
+    def invalidate_answers(name):
+        answer_cache.invalidate("doc_gen" if name in DOC_ACTS else "chat")
+
+    preload()
+    registry.on_reload(invalidate_answers)
+
+def load_agents():
+    import doc_gen
+    import bail
+    from qa import act_router
+    doc_gen.warm_up()
+    act_router.profiles()
+
+def load_sections():
+    from database import section_index
+    section_index.load()
+    section_index.start_watching()
+
+WARM_UP = [
+    ("stats", export_stats),
+    ("indexes", load_indexes),
+    ("agents", load_agents),
+    ("sections", load_sections),
+]
+
+if PRELOAD:
+    try:
+        preload()
+        # Keeps the collector from touching, and so copying, the preloaded objects in every worker
+        gc.freeze()
+    except Exception:
+        logger.exception("preload failed, workers load the indexes themselves")
+
+@asynccontextmanager
+async def lifespan(app):
+    lifecycle.start(WARM_UP)
+    yield
+    await lifecycle.stop()
+    from mongo import mongo
+    mongo.close()
+
+app = FastAPI(lifespan=lifespan)
+app.state.lifecycle = lifecycle
 
 app.add_middleware(
     CORSMiddleware,
@@ -17,52 +107,183 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+telemetry.instrument(app, "api")
+lifecycle.routes(app)
+
+ready = [Depends(lifecycle.wait)]
+
+@app.get("/health/mongo")
+async def mongo_health():
+    from mongo import mongo
+    return {"ok": await run_blocking(mongo.ping), "pool": mongo.stats()}
+
 class QueryRequest(BaseModel):
     query: str
+    # Skip the ReAct agent and query the index directly, None follows DIRECT_MODE
+    direct: Optional[bool] = None
+    rewrite: Optional[bool] = None
+
+def pipeline(request: QueryRequest, agent, direct):
+    if not (DIRECT_MODE if request.direct is None else request.direct):
+        return agent
+    return partial(direct, rewrite=request.rewrite) if request.rewrite is not None else direct
+
+def flight_key(endpoint, request: QueryRequest):
+    from embed_cache import normalize_text
+    direct = DIRECT_MODE if request.direct is None else request.direct
+    return (endpoint, normalize_text(request.query), direct, request.rewrite)
+
+def answer_namespace(endpoint, request: QueryRequest):
+    from answer_cache import mode_namespace
+    from query_rewrite import QUERY_REWRITE
+    direct = DIRECT_MODE if request.direct is None else request.direct
+    rewrite = QUERY_REWRITE if request.rewrite is None else request.rewrite
+    return mode_namespace(endpoint, direct, rewrite)
 
 def remove_formatting(output):
-    output = re.sub(r'\[[0-9;m]+', '', output)  
-    output = re.sub(r'\x1b', '', output) 
+    output = re.sub(r'\[[0-9;m]+', '', output)
+    output = re.sub(r'\x1b', '', output)
     return output.strip()
 
-@app.post("/chat")
+async def cached_answer(namespace, query, compute):
+    from answer_cache import answer_cache
+    from lexical import is_lexical
+    from llama_index.core import Settings
+    # Identifier queries are cached by text and retrieved by BM25, they never need the embedding
+    embedding = None if is_lexical(query) else await Settings.embed_model.aget_query_embedding(query)
+    answer = answer_cache.get(namespace, query, embedding)
+    if answer is not None:
+        return answer, True
+    output = (await compute(query=query)).get("output")
+    with telemetry.span("serialize"):
+        answer = jsonable_encoder(output)
+    answer_cache.put(namespace, query, embedding, answer)
+    return answer, False
+
+def cache_response(answer, cached):
+    if isinstance(answer, dict):
+        answer = {**answer, "cached": cached}
+    return JSONResponse(content=answer, headers={"X-Cache": "HIT" if cached else "MISS"})
+
+@app.post("/chat", dependencies=ready)
 async def chat(request: QueryRequest):
+    from qa import RAG
     try:
-        result = RAG.processing_agent(query=request.query)
-        final_output = result.get("output")
-        return final_output
+        final_output, cached = await request_flight.do(
+            flight_key("chat", request),
+            lambda: cached_answer(answer_namespace("chat", request), request.query, pipeline(request, RAG.aprocessing_agent, RAG.adirect)),
+        )
+        return cache_response(final_output, cached)
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
-    
-@app.post("/doc_gen")
+
+@app.post("/doc_gen", dependencies=ready)
 async def chat(request: QueryRequest):
+    from doc_gen import apreprocessing, adirect
     try:
-        result = preprocessing(query=request.query)
-        final_output = result.get("output")
-        return final_output
+        final_output, cached = await request_flight.do(
+            flight_key("doc_gen", request),
+            lambda: cached_answer(answer_namespace("doc_gen", request), request.query, pipeline(request, apreprocessing, adirect)),
+        )
+        return cache_response(final_output, cached)
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
-    
-@app.post("/bail_application/")
+
+async def stream_answer(namespace, query, compute):
+    answer, cached = await cached_answer(namespace, query, compute)
+    return {"output": answer, "cached": cached}
+
+@app.post("/chat/stream", dependencies=ready)
+async def chat_stream(request: QueryRequest):
+    from qa import RAG
+    import streaming
+    events = streaming.event_stream(lambda: stream_answer(answer_namespace("chat", request), request.query, pipeline(request, RAG.astream_agent, RAG.astream_direct)))
+    return StreamingResponse(events, media_type="text/event-stream")
+
+@app.post("/doc_gen/stream", dependencies=ready)
+async def doc_gen_stream(request: QueryRequest):
+    from doc_gen import astream_preprocessing, astream_direct
+    import streaming
+    events = streaming.event_stream(lambda: stream_answer(answer_namespace("doc_gen", request), request.query, pipeline(request, astream_preprocessing, astream_direct)))
+    return StreamingResponse(events, media_type="text/event-stream")
+
+class BatchRequest(BaseModel):
+    queries: List[str]
+    direct: Optional[bool] = None
+    rewrite: Optional[bool] = None
+
+def batch_options(request: BatchRequest):
+    from batch import BATCH_MAX_QUERIES
+    from query_rewrite import QUERY_REWRITE
+    if not request.queries:
+        raise HTTPException(status_code=422, detail="send at least one query")
+    if len(request.queries) > BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=413, detail=f"send at most {BATCH_MAX_QUERIES} queries")
+    # Batches default to direct mode, the agent only adds a hop per question
+    return {
+        "direct": True if request.direct is None else request.direct,
+        "rewrite": QUERY_REWRITE if request.rewrite is None else request.rewrite,
+    }
+
+@app.post("/chat/batch", dependencies=ready)
+async def chat_batch(request: BatchRequest):
+    from batch import answer_batch
+    import streaming
+    options = batch_options(request)
+
+    async def events():
+        try:
+            async for event, data in answer_batch(request.queries, **options):
+                yield streaming.sse(event, data)
+            yield streaming.sse("done", {})
+        except Exception as e:
+            yield streaming.sse("error", {"error": str(e)})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.post("/chat/batch/jobs", dependencies=ready, status_code=202)
+async def start_batch_job(request: BatchRequest):
+    from batch import batch_jobs
+    return batch_jobs.start(request.queries, **batch_options(request))
+
+@app.get("/chat/batch/jobs/{job_id}")
+async def batch_job(job_id: str):
+    from batch import batch_jobs
+    job = batch_jobs.get(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "job not found"}, status_code=404)
+    return job
+
+def server_timing(timings):
+    return ", ".join(f"{name};dur={duration * 1000:.1f}" for name, duration in timings.items())
+
+@app.post("/bail_application/", dependencies=ready)
 async def submit_bail_application(request: Request):
-    
+    from bail import reckoner
+
     application = await request.json()
-    reckoner = Reckoner()
-    
-    print(application)
-    
-    selected_act = application.get('case_details', {}).get('Acts of Offence', [])
-    sections_input = application.get('case_details', {}).get('sections_of_offence', [])
-    print(type(selected_act))
-    print(type(sections_input))
-
-    # Fetch, parse, and process the data
-    acts = reckoner.fetch(selected_act, sections_input)
-    parsed = reckoner.parse(acts)
-    offences = reckoner.llm_parser(parsed)
-    application['offences'] = offences
-    # Evaluate the final result
-    print(application)
-    result = reckoner.evaluator(application)
-    print(result)
-    return result
\ No newline at end of file
+    key = ("bail", json.dumps(application, sort_keys=True))
+    result, timings = await request_flight.do(key, lambda: reckoner.assess(application))
+    return JSONResponse(content=result, headers={"Server-Timing": server_timing(timings)})
+
+@app.post("/bail_application/stream", dependencies=ready)
+async def stream_bail_application(request: Request):
+    from bail import reckoner
+    import streaming
+
+    application = await request.json()
+
+    async def run():
+        timings = {}
+        offences, prev = await reckoner.aprepare(application, timings)
+        streaming.emit("offences", [offence.get('Section_Number') for offence in offences])
+        streaming.emit("timings", timings)
+        application['offences'] = offences
+
+        result = ""
+        async for token in reckoner.astream_evaluator(application, prev):
+            result += token
+            streaming.emit("token", token)
+        return result
+
+    return StreamingResponse(streaming.event_stream(run), media_type="text/event-stream")
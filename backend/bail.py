@@ -1,16 +1,23 @@
 import os
 import regex as re
 import json
-from pymongo.mongo_client import MongoClient
-from pymongo.server_api import ServerApi
 from google import generativeai as genai
-from time import time
+from time import time, perf_counter
+import asyncio
+import threading
 from prompt_library import Prompt
-from database import get_desc
+from database import get_desc, aget_desc, section_index
+import citations
+import telemetry
+from concurrency import run_blocking
 
 genai.configure(api_key=os.environ["GEMINI_API_KEY"])
-uri = os.environ['MONGO_URI']
-client = MongoClient(uri, server_api=ServerApi('1'))
+
+logger = telemetry.get_logger("bail")
+
+LLM_PARSE_FALLBACK = os.environ.get("BAIL_LLM_PARSE_FALLBACK", "").lower() in ("1", "true", "yes")
+STAGE_TIMEOUT = float(os.environ.get("BAIL_STAGE_TIMEOUT", 30))
+EVAL_TIMEOUT = float(os.environ.get("BAIL_EVAL_TIMEOUT", 120))
 
 acts = {
     "THE BHARATIYA NYAYA SANHITA, 2023": "BNS",
@@ -31,40 +38,126 @@ acts = {
     "THE UNLAWFUL ACTIVITIES (PREVENTION) ACT, 1967":"UAPA"
 }
 
+def _usage(response):
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "prompt_token_count", None), getattr(usage, "candidates_token_count", None)
+
 class Reckoner:
     def __init__(self) -> None:
-        pass
+        self._models = {}
+        self._lock = threading.Lock()
 
     def llm(self, instruction:str):
-        return genai.GenerativeModel('gemini-1.5-flash', system_instruction=instruction)
+        with self._lock:
+            model = self._models.get(instruction)
+            if model is None:
+                model = genai.GenerativeModel('gemini-1.5-flash', system_instruction=instruction)
+                self._models[instruction] = model
+        return model
+
+    async def _stage(self, timings: dict, name: str, coro, timeout: float):
+        start = perf_counter()
+        try:
+            return await asyncio.wait_for(coro, timeout)
+        finally:
+            timings[name] = perf_counter() - start
+            telemetry.record(f"bail_{name}", start, timings[name])
+
+    def _generate(self, model, prompt):
+        start = perf_counter()
+        response = model.generate_content(prompt)
+        telemetry.llm_call(model.model_name, start, perf_counter() - start, *_usage(response))
+        return response.text
+
+    async def _agenerate(self, model, prompt):
+        start = perf_counter()
+        response = await model.generate_content_async(prompt)
+        telemetry.llm_call(model.model_name, start, perf_counter() - start, *_usage(response))
+        return response.text
+
+    async def aoffences(self, application: dict, timings: dict):
+        selected_act = application.get('case_details', {}).get('Acts of Offence', [])
+        sections_input = application.get('case_details', {}).get('sections_of_offence', [])
+
+        acts = await self._stage(timings, "fetch", self.afetch(selected_act, sections_input), STAGE_TIMEOUT)
+        parsed = await self._stage(timings, "parse", self.aparse(acts), STAGE_TIMEOUT)
+        return await self._stage(timings, "offences", self.allm_parser(parsed), STAGE_TIMEOUT)
+
+    async def aprepare(self, application: dict, timings: dict):
+        # Current offences and previous-case sections are independent, fetch them together
+        return await asyncio.gather(
+            self.aoffences(application, timings),
+            self._stage(timings, "previous", Prompt.aprevious(application), STAGE_TIMEOUT),
+        )
+
+    async def assess(self, application: dict):
+        timings = {}
+        offences, prev = await self.aprepare(application, timings)
+        application['offences'] = offences
+        result = await self._stage(timings, "evaluate", self.aevaluator(application, prev), EVAL_TIMEOUT)
+        return result, timings
     
 
     def fetch(self, collection_name: list, section_number: str):
         collection_name = [acts[col] for col in collection_name]
-        print(collection_name)
+        logger.debug("fetching sections from %s", collection_name)
         return get_desc(collection_name, section_number)
 
 
+    async def afetch(self, collection_name: list, section_number: str):
+        collection_name = [acts[col] for col in collection_name]
+        return await aget_desc(collection_name, section_number)
+
     def parse(self, text:str):
+        parsed = citations.extract(text)
+        if not parsed and LLM_PARSE_FALLBACK and citations.has_citations(text):
+            return self.llm_parse(text)
+        return parsed
+
+    async def aparse(self, text:str):
+        parsed = citations.extract(text)
+        if not parsed and LLM_PARSE_FALLBACK and citations.has_citations(text):
+            return await self.allm_parse(text)
+        return parsed
+
+    def llm_parse(self, text:str):
+        model = self.llm(instruction=Prompt.ParseInstruction)
+        parsed_response = self._generate(model, Prompt.ParsePrompt(text))
+        json_string = re.search(r'\{.*\}', parsed_response, re.DOTALL)
+        return json.loads(json_string.group(0))
+
+    async def allm_parse(self, text:str):
         model = self.llm(instruction=Prompt.ParseInstruction)
-        parsed_response = model.generate_content(Prompt.ParsePrompt(text)).text
+        parsed_response = await self._agenerate(model, Prompt.ParsePrompt(text))
         json_string = re.search(r'\{.*\}', parsed_response, re.DOTALL)
         return json.loads(json_string.group(0))
     
     def llm_parser(self, data:dict):
-        results = {}
-        # collection_name = [acts[col] for col in collection_name]
-        for collection_name, sections in data.items():
-            print(collection_name, "llmparser")
-            print(sections)
-            collection = client['Indian_Acts'][collection_name]
-            query = {'Section_Number': {'$in': sections}}
-            result = collection.find(query)
-            response = [res for res in result]
-        
-        return response
+        return section_index.find_all(data)
+
+    async def allm_parser(self, data:dict):
+        return await run_blocking(section_index.find_all, data)
     
     def evaluator(self, input):
         model = self.llm(instruction=Prompt.evaluator)
-        return model.generate_content(Prompt.evalPrompt(input)).text
+        return self._generate(model, Prompt.evalPrompt(input))
+
+    async def aevaluator(self, input, prev=None):
+        model = self.llm(instruction=Prompt.evaluator)
+        return await self._agenerate(model, await Prompt.aevalPrompt(input, prev))
+
+    async def astream_evaluator(self, input, prev=None):
+        model = self.llm(instruction=Prompt.evaluator)
+        prompt = await Prompt.aevalPrompt(input, prev)
+        start = perf_counter()
+        response = await model.generate_content_async(prompt, stream=True)
+        chunk = None
+        try:
+            async for chunk in response:
+                yield chunk.text
+        finally:
+            # Usage totals arrive with the last chunk
+            telemetry.llm_call(model.model_name, start, perf_counter() - start, *_usage(chunk))
+
 
+reckoner = Reckoner()
@@ -0,0 +1,234 @@
+import os
+import time
+import uuid
+import asyncio
+import numpy as np
+from typing import Dict, List
+
+from fastapi.encoders import jsonable_encoder
+from llama_index.core import Settings
+from llama_index.core.callbacks.schema import CBEventType, EventPayload
+from llama_index.core.schema import QueryBundle
+
+import citations
+import telemetry
+from answer_cache import ANSWER_CACHE_THRESHOLD, answer_cache, mode_namespace
+from concurrency import run_blocking
+from embed_cache import normalize_text
+from lexical import is_lexical
+from qa import RAG, act_router
+from query_rewrite import QUERY_REWRITE, rewrite as rewrite_query
+from registry import QA_ACTS, registry
+from retrieval import HYBRID_CANDIDATES, normalize
+from statutes import statute_lookup
+
+BATCH_MAX_QUERIES = int(os.environ.get("BATCH_MAX_QUERIES", 1000))
+# LLM calls in flight per batch, embedding and retrieval already run as one pass
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 4))
+# Questions at least this similar to an earlier one in the batch share its answer
+BATCH_DEDUPE_THRESHOLD = float(os.environ.get("BATCH_DEDUPE_THRESHOLD", ANSWER_CACHE_THRESHOLD))
+BATCH_JOB_TTL = float(os.environ.get("BATCH_JOB_TTL", 60 * 60))
+
+# Same depth as the /chat query engines
+SIMILARITY_TOP_K = 3
+
+logger = telemetry.get_logger("batch")
+
+batch_queries = telemetry.metrics.counter("batch_queries_total", "Questions received in batches by how they were answered", ["outcome"])
+
+
+def near_duplicates(matrix, threshold: float, fingerprints=None):
+    # leaders[i] is the first question that question i is a near-duplicate of, itself when there is none.
+    # Like the answer cache, questions citing different sections never share an answer
+    scores = matrix @ matrix.T
+    if fingerprints is not None:
+        keys = {fingerprint: n for n, fingerprint in enumerate(dict.fromkeys(fingerprints))}
+        groups = np.asarray([keys[fingerprint] for fingerprint in fingerprints])
+        scores[groups[:, None] != groups[None, :]] = -np.inf
+    leaders = np.arange(len(matrix))
+    for i in range(len(matrix)):
+        if leaders[i] != i:
+            continue
+        later = np.flatnonzero(scores[i, i + 1:] >= threshold) + i + 1
+        later = later[leaders[later] == later]
+        leaders[later] = i
+    return leaders
+
+
+def retrieve(items, top_k: int = SIMILARITY_TOP_K):
+    # items are (question, embedding, act index) for questions routed to a single act,
+    # one matrix product scores all of them against their act
+    multi_act = registry.multi_act(list(act_router.acts.values()))
+    hits = [multi_act.acts[name].lexical_hits(question, top_k) for question, _, name in items]
+    embedded = [item for item, question_hits in zip(items, hits) if question_hits is None]
+    if embedded:
+        vector_hits = iter(multi_act.search_each(
+            [embedding for _, embedding, _ in embedded],
+            [name for _, _, name in embedded],
+            k=max(top_k, HYBRID_CANDIDATES),
+        ))
+        hits = [
+            question_hits if question_hits is not None else
+            multi_act.acts[name].hybrid_hits(question, next(vector_hits), top_k)
+            for (question, _, name), question_hits in zip(items, hits)
+        ]
+
+    prefetched = []
+    for (question, _, name), question_hits in zip(items, hits):
+        engine = registry.query_engine(name, similarity_top_k=top_k)
+        with Settings.callback_manager.event(
+            CBEventType.RETRIEVE, payload={EventPayload.QUERY_STR: question}
+        ) as retrieve_event:
+            nodes = engine.retriever.nodes_from_hits(question_hits)
+            retrieve_event.on_end(payload={EventPayload.NODES: nodes})
+        prefetched.append((engine, nodes))
+    return prefetched
+
+
+async def answer_batch(queries: List[str], direct: bool = True, rewrite: bool = QUERY_REWRITE, concurrency: int = BATCH_CONCURRENCY):
+    # Yields ("plan", ...) once, then ("result", ...) per group of duplicate questions as each one completes
+    unique = {}
+    for i, query in enumerate(queries):
+        unique.setdefault(normalize_text(query), []).append(i)
+    unique = list(unique.values())
+    texts = [queries[indices[0]] for indices in unique]
+    questions = [rewrite_query(text, QA_ACTS) if direct and rewrite else text for text in texts]
+
+    # One embedding request covers the questions as asked and as rewritten for retrieval
+    to_embed = list(dict.fromkeys(texts + questions))
+    vectors = dict(zip(to_embed, await Settings.embed_model.aget_text_embedding_batch(to_embed)))
+
+    leaders = near_duplicates(
+        normalize([vectors[text] for text in texts]),
+        BATCH_DEDUPE_THRESHOLD,
+        [citations.fingerprint(text) for text in texts],
+    )
+    groups = {}
+    for i, leader in enumerate(leaders):
+        groups.setdefault(int(leader), []).extend(unique[i])
+    batch_queries.inc(len(queries) - len(groups), outcome="duplicate")
+
+    yield "plan", {"queries": len(queries), "unique": len(texts), "groups": len(groups)}
+
+    def result(leader, output, cached):
+        return {"indices": sorted(groups[leader]), "query": texts[leader], "output": output, "cached": cached}
+
+    # Shares entries with /chat requests made in the same mode
+    namespace = mode_namespace("chat", direct, rewrite)
+
+    def cache_key(text):
+        # Same keys as /chat, identifier queries are cached by text
+        return None if is_lexical(text) else vectors[text]
+
+    pending = []
+    for leader in groups:
+        answer = answer_cache.get(namespace, texts[leader], cache_key(texts[leader]))
+        if answer is None:
+            pending.append(leader)
+            continue
+        batch_queries.inc(outcome="cache")
+        yield "result", result(leader, answer, True)
+
+    prefetched = {}
+    if direct:
+        # Cited sections keep the statute fast path, cross-act questions the routed engine below
+        single = []
+        for leader in pending:
+            question = questions[leader]
+            if citations.has_citations(question):
+                continue
+            acts = act_router.route(vectors[question])
+            if len(acts) == 1:
+                single.append((leader, (question, vectors[question], act_router.acts[acts[0]])))
+        if single:
+            nodes = await run_blocking(retrieve, [item for _, item in single])
+            prefetched = dict(zip([leader for leader, _ in single], nodes))
+    query_engine = await run_blocking(RAG().query_engine) if direct and len(prefetched) < len(pending) else None
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def answer(leader):
+        query, question = texts[leader], questions[leader]
+        async with semaphore:
+            if not direct:
+                output = (await RAG.aprocessing_agent(query)).get("output")
+            elif leader in prefetched:
+                engine, nodes = prefetched[leader]
+                output = await engine.asynthesize(QueryBundle(question, embedding=vectors[question]), nodes)
+            else:
+                output = await statute_lookup.aanswer(question)
+                if output is None:
+                    output = await query_engine.aquery(QueryBundle(question, embedding=vectors[question]))
+        answer = jsonable_encoder(output)
+        answer_cache.put(namespace, query, cache_key(query), answer)
+        return answer
+
+    async def settle(leader):
+        try:
+            return leader, await answer(leader), None
+        except Exception as e:
+            logger.exception("batch question failed: %s", texts[leader])
+            return leader, None, str(e)
+
+    tasks = [asyncio.ensure_future(settle(leader)) for leader in pending]
+    try:
+        for task in asyncio.as_completed(tasks):
+            leader, answer, error = await task
+            if error is not None:
+                batch_queries.inc(outcome="error")
+                yield "result", {"indices": sorted(groups[leader]), "query": texts[leader], "error": error}
+            else:
+                batch_queries.inc(outcome="answered")
+                yield "result", result(leader, answer, False)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class BatchJobs:
+    # Jobs live in the worker that accepted them, poll through the same worker or a sticky session
+    def __init__(self, ttl: float = BATCH_JOB_TTL) -> None:
+        self.ttl = ttl
+        self._jobs = {}
+        self._tasks = {}
+
+    def _expire(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self._jobs.items() if job["expires"] < now]:
+            self._jobs.pop(job_id)
+            task = self._tasks.pop(job_id, None)
+            if task is not None:
+                task.cancel()
+
+    def start(self, queries: List[str], **kwargs) -> Dict:
+        self._expire()
+        job_id = uuid.uuid4().hex
+        job = {"id": job_id, "status": "running", "plan": None, "results": [], "error": None, "expires": time.time() + self.ttl}
+        self._jobs[job_id] = job
+
+        async def run():
+            try:
+                async for event, data in answer_batch(queries, **kwargs):
+                    if event == "plan":
+                        job["plan"] = data
+                    else:
+                        job["results"].append(data)
+                job["status"] = "done"
+            except Exception as e:
+                logger.exception("batch job %s failed", job_id)
+                job["status"], job["error"] = "failed", str(e)
+            finally:
+                self._tasks.pop(job_id, None)
+
+        self._tasks[job_id] = asyncio.ensure_future(run())
+        return self.get(job_id)
+
+    def get(self, job_id: str):
+        self._expire()
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        return {key: value for key, value in job.items() if key != "expires"}
+
+
+batch_jobs = BatchJobs()
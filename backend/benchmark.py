@@ -0,0 +1,518 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import importlib.util
+import resource
+import subprocess
+import tempfile
+from datetime import datetime
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+# Only the benchmark needs these, they are listed in requirements-bench.txt
+BENCH_MODULES = ["httpx", "mongomock", "mongomock_motor"]
+
+# Nothing below may reach Azure, Gemini or Atlas, point every credential at a dead end
+FAKE_ENV = {
+    "AZURE_API_KEY": "benchmark",
+    "AZURE_ENDPOINT": "https://benchmark.invalid",
+    "AZURE_VERSION": "2024-02-01",
+    "AZURE_EMBED_ENDPOINT": "https://benchmark.invalid",
+    "AZURE_EMBED_VERSION": "2024-02-01",
+    "GEMINI_API_KEY": "benchmark",
+    "MONGO_URI": "mongodb://benchmark.invalid:27017",
+    # Embeddings of the fake model must not end up in the real caches
+    "EMBED_CACHE_PATH": "",
+    "DOC_ROUTER_DIR": os.path.join(tempfile.gettempdir(), "benchmark_doc_router"),
+}
+
+CHAT_QUERIES = [
+    "What does section 185 of the Motor Vehicles Act say?",
+    "Is third party insurance mandatory for two wheelers?",
+    "How do I file a complaint with the district consumer forum?",
+    "What are the powers of the IRDAI over insurance intermediaries?",
+    "Can an insurer repudiate a life insurance policy after three years?",
+    "What compensation is payable in a hit and run accident?",
+    "What happens if I drive without a valid driving licence?",
+    "Who can appeal against an order of the State Commission?",
+]
+DOC_QUERIES = [
+    "Draft a rent agreement for a two bedroom flat in Lucknow.",
+    "Prepare a sale deed for agricultural land.",
+    "Draft an RTI application asking for the status of my passport.",
+    "Draft a legal notice for breach of contract by a supplier.",
+    "Prepare a gift deed of a house to my daughter.",
+]
+BAIL_APPLICATION = {
+    "case_details": {
+        "Acts of Offence": ["THE INDIAN PENAL CODE"],
+        "sections_of_offence": "323, 341",
+    },
+    "previous_case": "yes",
+    "prev_offence_acts": ["IPC"],
+    "prev_sections_offence": "379",
+}
+SECTIONS = {
+    "IPC": {
+        "323": "Punishment for voluntarily causing hurt, see also section 324 IPC.",
+        "341": "Punishment for wrongful restraint under section 341 IPC.",
+        "379": "Punishment for theft, read with section 378 IPC.",
+        "324": "Voluntarily causing hurt by dangerous weapons or means.",
+        "378": "Theft.",
+    },
+    "CrPC": {
+        "41A": "Notice of appearance before police officer.",
+        "437": "When bail may be taken in case of non-bailable offence.",
+    },
+}
+
+BATCH_SIZE = 20
+
+SCENARIOS = ["chat", "chat_direct", "chat_batch", "doc_gen", "doc_gen_direct", "bail", "save_chat", "sessions", "messages"]
+
+
+def _vector(text: str, dim: int):
+    import numpy as np
+    seed = int(hashlib.sha256(text.encode()).hexdigest()[:16], 16)
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32).tolist()
+
+
+def _last_question(prompt: str) -> str:
+    for marker in ("<User Question>", "Question:", "Query:"):
+        if marker in prompt:
+            prompt = prompt.rsplit(marker, 1)[1]
+            break
+    lines = [line.strip() for line in prompt.strip().splitlines() if line.strip()]
+    return lines[0] if lines else ""
+
+
+def _sub_questions(prompt: str) -> str:
+    # LLMQuestionGenerator lists the tools as a json block after the last <Tools> marker
+    tools = {}
+    tools_text = prompt.rsplit("<Tools>", 1)[-1]
+    if "```json" in tools_text:
+        try:
+            tools = json.loads(tools_text.split("```json", 1)[1].split("```", 1)[0])
+        except ValueError:
+            tools = {}
+    question = _last_question(prompt)
+    items = [{"sub_question": question, "tool_name": name} for name in list(tools)[:2]]
+    return "```json\n" + json.dumps(items) + "\n```"
+
+
+class Counters:
+    def __init__(self) -> None:
+        self.llm = 0
+        self.agent_llm = 0
+        self.gemini = 0
+        self.embedding_calls = 0
+        self.embedded_texts = 0
+
+    def snapshot(self) -> dict:
+        return dict(self.__dict__)
+
+
+counters = Counters()
+
+
+def install_fakes(llm_latency: float, embed_latency: float, dim: int = 1536):
+    # Imported here, after FAKE_ENV is in place
+    from typing import Any, List, Optional
+
+    from llama_index.core import Settings
+    from llama_index.core.base.embeddings.base import BaseEmbedding
+    from llama_index.core.llms import CompletionResponse, CustomLLM, LLMMetadata
+    from llama_index.core.llms.callbacks import llm_completion_callback
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+
+    import mongomock
+    from mongomock_motor import AsyncMongoMockClient
+
+    def answer(prompt: str) -> str:
+        if "sub_question" in prompt and "tool_name" in prompt:
+            return _sub_questions(prompt)
+        words = _last_question(prompt).split()[:12]
+        return "Fake answer about " + " ".join(words) + ". " + " ".join(["Lorem ipsum dolor sit amet."] * 8)
+
+    class FakeLLM(CustomLLM):
+        latency: float = 0.0
+
+        @property
+        def metadata(self) -> LLMMetadata:
+            return LLMMetadata(context_window=8192, num_output=512, model_name="benchmark-llm")
+
+        @llm_completion_callback()
+        def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+            counters.llm += 1
+            time.sleep(self.latency)
+            return CompletionResponse(text=answer(prompt))
+
+        @llm_completion_callback()
+        def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+            counters.llm += 1
+            time.sleep(self.latency)
+            text = ""
+            for word in answer(prompt).split(" "):
+                text += word + " "
+                yield CompletionResponse(text=text, delta=word + " ")
+
+        @llm_completion_callback()
+        async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+            counters.llm += 1
+            await asyncio.sleep(self.latency)
+            return CompletionResponse(text=answer(prompt))
+
+        @llm_completion_callback()
+        async def astream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+            counters.llm += 1
+            await asyncio.sleep(self.latency)
+
+            async def gen():
+                text = ""
+                for word in answer(prompt).split(" "):
+                    text += word + " "
+                    yield CompletionResponse(text=text, delta=word + " ")
+            return gen()
+
+    class FakeEmbedding(BaseEmbedding):
+        latency: float = 0.0
+        dim: int = 1536
+
+        def _embed(self, texts: List[str]):
+            counters.embedding_calls += 1
+            counters.embedded_texts += len(texts)
+            return [_vector(text, self.dim) for text in texts]
+
+        def _get_query_embedding(self, query: str):
+            time.sleep(self.latency)
+            return self._embed([query])[0]
+
+        async def _aget_query_embedding(self, query: str):
+            await asyncio.sleep(self.latency)
+            return self._embed([query])[0]
+
+        def _get_text_embedding(self, text: str):
+            return self._get_text_embeddings([text])[0]
+
+        def _get_text_embeddings(self, texts: List[str]):
+            time.sleep(self.latency)
+            return self._embed(texts)
+
+        async def _aget_text_embeddings(self, texts: List[str]):
+            await asyncio.sleep(self.latency)
+            return self._embed(texts)
+
+    class FakeChatModel(BaseChatModel):
+        # Stands in for the ReAct agent's AzureChatOpenAI, always hands the question to the one tool
+        latency: float = 0.0
+
+        @property
+        def _llm_type(self) -> str:
+            return "benchmark-chat"
+
+        def _result(self, messages) -> ChatResult:
+            counters.agent_llm += 1
+            question = _last_question(str(messages[-1].content))
+            text = f"Thought: I should use the tool.\nAction: Llama-Index\nAction Input: {question}"
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+        def _generate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+            time.sleep(self.latency)
+            return self._result(messages)
+
+        async def _agenerate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+            await asyncio.sleep(self.latency)
+            return self._result(messages)
+
+    class FakeGeminiResponse:
+        def __init__(self, text: str) -> None:
+            self.text = text
+
+    class FakeGeminiStream:
+        def __init__(self, text: str) -> None:
+            self.chunks = [FakeGeminiResponse(word + " ") for word in text.split(" ")]
+
+        def __aiter__(self):
+            return self._iter()
+
+        async def _iter(self):
+            for chunk in self.chunks:
+                yield chunk
+
+    class FakeGenerativeModel:
+        def __init__(self, model_name: str, system_instruction: str = None, **kwargs: Any) -> None:
+            self.model_name = model_name
+
+        def generate_content(self, prompt, **kwargs: Any):
+            counters.gemini += 1
+            time.sleep(llm_latency)
+            return FakeGeminiResponse("Bail may be granted subject to conditions. " * 10)
+
+        async def generate_content_async(self, prompt, stream: bool = False, **kwargs: Any):
+            counters.gemini += 1
+            await asyncio.sleep(llm_latency)
+            text = "Bail may be granted subject to conditions. " * 10
+            return FakeGeminiStream(text) if stream else FakeGeminiResponse(text)
+
+    import mongo as mongo_module
+    store = mongomock.MongoClient()
+    mongo_module.MongoClient = lambda *args, **kwargs: store
+
+    # utils sets the Azure models on import, it has to run before they are replaced
+    import utils
+    from embed_cache import CachedEmbedding
+    utils.llm = Settings.llm = FakeLLM(latency=llm_latency)
+    utils.embed_model = Settings.embed_model = CachedEmbedding(FakeEmbedding(latency=embed_latency, dim=dim))
+
+    chat_model = FakeChatModel(latency=llm_latency)
+    return store, AsyncMongoMockClient(mock_mongo_client=store), chat_model, FakeGenerativeModel
+
+
+def seed(store, users: int):
+    for act, sections in SECTIONS.items():
+        store.Indian_Acts[act].insert_many(
+            [{"Section_Number": number, "Description": description} for number, description in sections.items()]
+        )
+    for n in range(users):
+        store.auth_db.users.insert_one({"username": f"user{n}", "password": "x"})
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = (len(values) - 1) * q
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+async def drive(client, requests, concurrency: int):
+    queue = asyncio.Queue()
+    for request in requests:
+        queue.put_nowait(request)
+    latencies = []
+    errors = []
+
+    async def worker():
+        while True:
+            try:
+                method, url, body = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, json=body)
+                if response.status_code >= 400:
+                    errors.append(f"{response.status_code} {url}: {response.text[:200]}")
+                elif "event: error" in response.text:
+                    # Streams report failures in the body after a 200
+                    errors.append(f"{url}: {response.text[response.text.index('event: error'):][:200]}")
+            except Exception as e:
+                errors.append(f"{url}: {e!r}")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+
+def summarize(latencies, errors, wall: float, before: dict, after: dict, concurrency: int) -> dict:
+    count = len(latencies)
+    per_request = {name: (after[name] - before[name]) / count if count else 0.0 for name in after}
+    return {
+        "requests": count,
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "concurrency": concurrency,
+        "wall_seconds": wall,
+        "throughput_rps": count / wall if wall else 0.0,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p95": percentile(latencies, 0.95) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "mean": sum(latencies) / count * 1000 if count else 0.0,
+            "max": max(latencies) * 1000 if latencies else 0.0,
+        },
+        "llm_calls_per_request": per_request["llm"],
+        "agent_llm_calls_per_request": per_request["agent_llm"],
+        "gemini_calls_per_request": per_request["gemini"],
+        "embedding_calls_per_request": per_request["embedding_calls"],
+        "embedded_texts_per_request": per_request["embedded_texts"],
+        "answer_cache_hit_rate": (after["cache_hits"] - before["cache_hits"]) / count if count else 0.0,
+    }
+
+
+def _requests(scenario: str, count: int, users: int, rng: random.Random, session_ids: dict):
+    requests = []
+    for n in range(count):
+        username = f"user{n % users}"
+        if scenario in ("chat", "chat_direct"):
+            body = {"query": rng.choice(CHAT_QUERIES), "direct": scenario == "chat_direct"}
+            requests.append(("POST", "/chat", body))
+        elif scenario == "chat_batch":
+            # A spreadsheet with repeated questions, BATCH_SIZE of them per request
+            body = {"queries": [rng.choice(CHAT_QUERIES) for _ in range(BATCH_SIZE)]}
+            requests.append(("POST", "/chat/batch", body))
+        elif scenario in ("doc_gen", "doc_gen_direct"):
+            body = {"query": rng.choice(DOC_QUERIES), "direct": scenario == "doc_gen_direct"}
+            requests.append(("POST", "/doc_gen", body))
+        elif scenario == "bail":
+            requests.append(("POST", "/bail_application/", json.loads(json.dumps(BAIL_APPLICATION))))
+        elif scenario == "save_chat":
+            body = {"username": username, "role": "user" if n % 2 else "assistant", "chat": rng.choice(CHAT_QUERIES)}
+            requests.append(("POST", "/chat/save_chat/", body))
+        elif scenario == "sessions":
+            requests.append(("GET", f"/chat/sessions/{username}?limit=20", None))
+        elif scenario == "messages":
+            session_id = session_ids.get(username)
+            if session_id is not None:
+                requests.append(("GET", f"/chat/sessions/{username}/{session_id}/messages?limit=50", None))
+    return requests
+
+
+def _commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+async def run(args) -> dict:
+    store, async_store, chat_model, generative_model = install_fakes(args.llm_latency, args.embed_latency)
+    seed(store, args.users)
+
+    import httpx
+    import bail
+    import doc_gen
+    import qa
+    from answer_cache import answer_cache
+    from mongo import mongo
+    from registry import registry
+
+    # The per-act OpenAI function-calling agents need a real OpenAI model, the benchmark
+    # routes straight to the act engines they would have called
+    doc_gen.agents = lambda: {act: registry.query_engine(act) for act in doc_gen.temp}
+    doc_gen._agent_llm = lambda: chat_model
+    qa.AzureChatOpenAI = lambda **kwargs: chat_model
+    bail.genai.GenerativeModel = generative_model
+    mongo._async_client = async_store
+    if not args.answer_cache:
+        answer_cache.threshold = 2.0
+
+    start = time.perf_counter()
+    registry.preload()
+    index_load = time.perf_counter() - start
+
+    import api
+    sys.path.insert(0, os.path.join(BACKEND_DIR, "API"))
+    import main as history_api
+    import db as history_db
+    history_db.mongo._async_client = async_store
+
+    results = {
+        "commit": _commit(),
+        "timestamp": datetime.utcnow().isoformat(),
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "llm_latency": args.llm_latency,
+            "embed_latency": args.embed_latency,
+            "users": args.users,
+            "answer_cache": args.answer_cache,
+            "seed": args.seed,
+        },
+        "index_load_seconds": index_load,
+        "startup_seconds": {},
+        "scenarios": {},
+    }
+
+    rng = random.Random(args.seed)
+    session_ids = {}
+    apps = {"api": api.app, "history": history_api.app}
+    for app_name, app in apps.items():
+        start = time.perf_counter()
+        async with app.router.lifespan_context(app):
+            # Warm-up runs in the background, startup lasts until the worker reports ready
+            await app.state.lifecycle.wait()
+            results["startup_seconds"][app_name] = time.perf_counter() - start
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+                for scenario in args.scenarios:
+                    if (scenario in ("save_chat", "sessions", "messages")) != (app_name == "history"):
+                        continue
+                    if scenario == "messages":
+                        # Give the write-behind chat logger time to flush before reading
+                        await asyncio.sleep(1.0)
+                        for doc in store.auth_db.history.find({}, {"username": 1, "session_id": 1}):
+                            session_ids.setdefault(doc["username"], doc["session_id"])
+                    requests = _requests(scenario, args.requests, args.users, rng, session_ids)
+                    # Every scenario starts cold, direct mode must not be served from the agent runs
+                    answer_cache.invalidate()
+                    before = dict(counters.snapshot(), cache_hits=answer_cache.hits)
+                    latencies, errors, wall = await drive(client, requests, args.concurrency)
+                    after = dict(counters.snapshot(), cache_hits=answer_cache.hits)
+                    results["scenarios"][scenario] = summarize(latencies, errors, wall, before, after, args.concurrency)
+                    print(f"{scenario}: {json.dumps(results['scenarios'][scenario]['latency_ms'])}")
+
+    # ru_maxrss is in kilobytes on Linux
+    results["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return results
+
+
+def compare(old: dict, new: dict):
+    print(f"{'scenario':<16}{'p50 ms':>20}{'p95 ms':>20}{'rps':>20}")
+    for scenario, result in new["scenarios"].items():
+        previous = old.get("scenarios", {}).get(scenario)
+        if previous is None:
+            continue
+        cells = []
+        for current, before in (
+            (result["latency_ms"]["p50"], previous["latency_ms"]["p50"]),
+            (result["latency_ms"]["p95"], previous["latency_ms"]["p95"]),
+            (result["throughput_rps"], previous["throughput_rps"]),
+        ):
+            change = (current - before) / before * 100 if before else 0.0
+            cells.append(f"{current:9.1f} ({change:+6.1f}%)")
+        print(f"{scenario:<16}" + "".join(f"{cell:>20}" for cell in cells))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the backend offline with fake Azure/Gemini models and an in-memory Mongo")
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument("--requests", type=int, default=50, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds per fake LLM call")
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="seconds per fake embedding call")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-answer-cache", dest="answer_cache", action="store_false")
+    parser.add_argument("--output", help="defaults to benchmark_results/<commit>.json")
+    parser.add_argument("--compare", help="earlier results to compare against")
+    args = parser.parse_args()
+
+    missing = [name for name in BENCH_MODULES if importlib.util.find_spec(name) is None]
+    if missing:
+        parser.error(f"missing {', '.join(missing)}, install them with pip install -r {os.path.join(BACKEND_DIR, 'requirements-bench.txt')}")
+
+    os.environ.update(FAKE_ENV)
+    os.chdir(BACKEND_DIR)
+    sys.path.insert(0, BACKEND_DIR)
+
+    results = asyncio.run(run(args))
+
+    output = args.output or os.path.join("benchmark_results", f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"index load {results['index_load_seconds']:.2f}s, peak RSS {results['peak_rss_mb']:.0f} MB -> {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
@@ -0,0 +1,105 @@
+import os
+import regex as re
+
+PARSE_ACTS = [act.strip() for act in os.environ.get("BAIL_PARSE_ACTS", "IPC,CrPC").split(",") if act.strip()]
+
+ACT_ALIASES = {
+    "IPC": [r"I\.?\s?P\.?\s?C\.?", r"Indian\s+Penal\s+Code", r"Penal\s+Code"],
+    "CrPC": [r"Cr\.?\s?P\.?\s?C\.?", r"Code\s+of\s+Criminal\s+Procedure", r"Criminal\s+Procedure\s+Code"],
+    "BNS": [r"BNS(?!S)", r"Bharatiya\s+Nyaya\s+Sanhita"],
+    "BNSS": [r"BNSS", r"Bharatiya\s+Nagarik\s+Suraksha\s+Sanhita"],
+    # Acts indexed for /chat
+    "IRDA": [r"IRDAI?(?:\s+Act)?", r"Insurance\s+Regulatory\s+and\s+Development\s+Authority(?:\s+of\s+India)?\s+Act"],
+    "Insurance": [r"Insurance\s+Act"],
+    "CPA": [r"CPA", r"C\.\s?P\.\s?Act", r"Consumer\s+Protection\s+Act"],
+    "MVA": [r"MVA", r"M\.?\s?V\.?\s?Act", r"Motor\s+Vehicles?\s+Act"],
+}
+
+KEYWORD = r"(?:u/ss?\.?|under\s+sections?|sections?|secs?\.?|ss\.|s\.)"
+# Sub-clauses come as digits or letters: 376(2)(n), 304(B), 66(1)(iv), and lettered sections as 304B or 304-B
+SECTION = r"(?<!\d)\d{1,3}(?!\d)(?:-[A-Z](?![A-Z])|[A-Z]{0,2})(?:\s?\(\s?(?:\d+[a-z]?|[a-z]{1,4})\s?\))*"
+SEPARATOR = r"\s*(?:,|/|&|\band\b|\bor\b|\bread\s+with\b|\br/w\b)\s*"
+SECTION_LIST = rf"{SECTION}(?:{SEPARATOR}{SECTION})*"
+YEAR = r"(?:\s*,?\s*\d{4})?"
+
+_act_names = {}
+_act_patterns = []
+for _n, (_code, _aliases) in enumerate(ACT_ALIASES.items()):
+    _act_names[f"act{_n}"] = _code
+    _act_patterns.append(rf"(?P<act{_n}>{'|'.join(_aliases)})")
+ACT = rf"(?:the\s+)?(?:{'|'.join(_act_patterns)})\b"
+
+READ_WITH = r"\s*(?:\br/w\b|\bread\s+with\b)\s*"
+# "section 302 IPC", "u/s 41A Cr.P.C.", "sections 302, 307 and 34 of the Indian Penal Code", "302/34 IPC",
+# and "302/34 IPC r/w 120B", where the sections after r/w belong to the same act unless another one follows
+SECTIONS_BEFORE_ACT = re.compile(
+    rf"(?:{KEYWORD}\s*)?(?P<sections>{SECTION_LIST})\s*,?\s*(?:of\s+)?{ACT}"
+    rf"(?:{READ_WITH}(?:{KEYWORD}\s*)?(?P<more>{SECTION_LIST})(?!\s*,?\s*(?:of\s+)?{ACT}))?",
+    re.IGNORECASE,
+)
+# "IPC section 302", "Indian Penal Code, 1860 sections 34 and 120B", "IPC 302"
+ACT_BEFORE_SECTIONS = re.compile(rf"{ACT}{YEAR}\s*,?\s*(?:{KEYWORD}\s*)?(?P<sections>{SECTION_LIST})", re.IGNORECASE)
+CITATION_HINT = re.compile(rf"{KEYWORD}\s*\d|{ACT}", re.IGNORECASE)
+
+_section = re.compile(SECTION, re.IGNORECASE)
+_section_parts = re.compile(r"(\d{1,3})-?([A-Z]{0,2})\s?(?:\(\s?([A-Z])\s?\))?", re.IGNORECASE)
+
+
+def _act(match) -> str:
+    for group, code in _act_names.items():
+        if match.group(group):
+            return code
+
+
+def _sections(text: str) -> list:
+    # A lone letter after the number is part of the section, 304(B) and 304-B are 304B.
+    # Only the section itself is looked up, numeric sub-sections like 376(2)(n) are dropped
+    sections = []
+    for section in _section.findall(text):
+        number, suffix, clause = _section_parts.match(section).groups()
+        sections.append((number + (suffix or clause or "")).upper())
+    return sections
+
+
+def extract(text, acts: list = None) -> dict:
+    if isinstance(text, (list, tuple)):
+        text = "\n".join(str(t) for t in text)
+    acts = PARSE_ACTS if acts is None else acts
+
+    found = []
+    for pattern in (SECTIONS_BEFORE_ACT, ACT_BEFORE_SECTIONS):
+        for match in pattern.finditer(text, overlapped=False):
+            sections = _sections(match.group("sections")) + _sections(match.groupdict().get("more") or "")
+            found.append((match.start(), _act(match), sections))
+
+    parsed = {}
+    for _, act, sections in sorted(found, key=lambda item: item[0]):
+        if act not in acts:
+            continue
+        act_sections = parsed.setdefault(act, [])
+        for section in sections:
+            if section not in act_sections:
+                act_sections.append(section)
+    return parsed
+
+
+def remove(text: str) -> str:
+    for pattern in (SECTIONS_BEFORE_ACT, ACT_BEFORE_SECTIONS):
+        text = pattern.sub(" ", text)
+    return text
+
+
+def has_citations(text) -> bool:
+    if isinstance(text, (list, tuple)):
+        text = "\n".join(str(t) for t in text)
+    return CITATION_HINT.search(text) is not None
+
+
+_number = re.compile(r"(?<![\w.])\d+[A-Z]{0,2}(?![\w.])", re.IGNORECASE)
+
+
+def fingerprint(text: str) -> tuple:
+    # The cited acts and sections plus every bare number, two questions that differ here ask about different law
+    cited = extract(text, acts=list(ACT_ALIASES))
+    numbers = sorted({number.upper() for number in _number.findall(remove(text))})
+    return tuple(sorted((act, tuple(sorted(sections))) for act, sections in cited.items())), tuple(numbers)
@@ -1,26 +1,163 @@
-from pymongo.mongo_client import MongoClient
-from pymongo.server_api import ServerApi
 import os
-from dotenv import load_dotenv
+import threading
+import time
+from mongo import mongo
+from concurrency import run_blocking
+from singleflight import SingleFlight
+import telemetry
 
-load_dotenv()
+SECTION_INDEX_REFRESH = float(os.environ.get("SECTION_INDEX_REFRESH", 15 * 60))
 
-uri = os.environ['MONGO_URI']
+logger = telemetry.get_logger("sections")
+
+# Requests that arrive before the first load share one read of the collections
+sections_flight = SingleFlight("sections")
+
+
+class SectionIndex:
+    def __init__(self, db_name: str, refresh_interval: float = SECTION_INDEX_REFRESH) -> None:
+        self.db_name = db_name
+        self.refresh_interval = refresh_interval
+        self.acts = {}
+        self.loaded_at = 0.0
+        self.watching = False
+        self._sections_by_id = {}
+        self._watcher = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    @property
+    def db(self):
+        return mongo.client[self.db_name]
+
+    @staticmethod
+    def _section_number(doc) -> str:
+        return str(doc.get('Section_Number', '')).strip()
+
+    def _load_collection(self, name: str):
+        sections, by_id = {}, {}
+        for doc in self.db[name].find():
+            number = self._section_number(doc)
+            sections.setdefault(number, []).append(doc)
+            by_id[doc.get('_id')] = number
+        return sections, by_id
+
+    def load(self):
+        loaded = {name: self._load_collection(name) for name in self.db.list_collection_names()}
+        with self._lock:
+            self.acts = {name: sections for name, (sections, _) in loaded.items()}
+            self._sections_by_id = {name: by_id for name, (_, by_id) in loaded.items()}
+            self.loaded_at = time.monotonic()
+
+    def reload_collection(self, name: str):
+        sections, by_id = self._load_collection(name)
+        with self._lock:
+            self.acts = {**self.acts, name: sections}
+            self._sections_by_id = {**self._sections_by_id, name: by_id}
+
+    def apply_change(self, change: dict):
+        # Patches the one changed document in, readers keep the snapshot they already hold
+        name = change['ns']['coll']
+        if change['operationType'] not in ('insert', 'update', 'replace', 'delete'):
+            self.reload_collection(name)
+            return
+        doc_id = change['documentKey']['_id']
+        doc = change.get('fullDocument')
+        with self._lock:
+            sections = dict(self.acts.get(name, {}))
+            by_id = dict(self._sections_by_id.get(name, {}))
+            old = by_id.pop(doc_id, None)
+            if old is not None:
+                remaining = [d for d in sections.get(old, []) if d.get('_id') != doc_id]
+                if remaining:
+                    sections[old] = remaining
+                else:
+                    sections.pop(old, None)
+            if doc is not None:
+                number = self._section_number(doc)
+                sections[number] = sections.get(number, []) + [doc]
+                by_id[doc_id] = number
+            self.acts = {**self.acts, name: sections}
+            self._sections_by_id = {**self._sections_by_id, name: by_id}
+
+    def _refresh(self):
+        try:
+            self.load()
+        except Exception:
+            logger.exception("section index refresh failed, serving the previous load")
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self._refresh()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name="section-index-refresh", daemon=True).start()
+
+    def _ensure_loaded(self):
+        if not self.loaded_at:
+            sections_flight.do_blocking(self.db_name, self.load)
+        elif self._watcher is None and time.monotonic() - self.loaded_at > self.refresh_interval:
+            # Stale sections are served while a background thread reloads, a request never waits on the refresh
+            self._refresh_in_background()
+
+    def _watch(self):
+        backoff = 1.0
+        while True:
+            try:
+                with self.db.watch(full_document='updateLookup') as stream:
+                    self.watching = True
+                    backoff = 1.0
+                    for change in stream:
+                        self.apply_change(change)
+            except Exception as e:
+                # Change streams need a replica set. Until one opens, poll every refresh_interval.
+                if self.watching or backoff == 1.0:
+                    logger.warning("section index watch unavailable, refreshing every %ss: %s", self.refresh_interval, e)
+            finally:
+                self.watching = False
+            if time.monotonic() - self.loaded_at > self.refresh_interval:
+                self._refresh()
+            time.sleep(min(backoff, self.refresh_interval))
+            backoff = min(backoff * 2, self.refresh_interval)
+
+    def start_watching(self):
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, name="section-index-watch", daemon=True)
+            self._watcher.start()
+
+    def find(self, act: str, sections: list) -> list:
+        self._ensure_loaded()
+        act_sections = self.acts.get(act, {})
+        docs = []
+        for section in sections:
+            docs.extend(act_sections.get(str(section).strip(), []))
+        return docs
+
+    def find_all(self, data: dict) -> list:
+        docs = []
+        for act, sections in data.items():
+            docs.extend(self.find(act, sections))
+        return docs
+
+
+section_index = SectionIndex('Indian_Acts')
 
-client = MongoClient(uri, server_api=ServerApi('1'))
 
 def get_desc(collection_name: list, section_number: str):
-    print(section_number)
-    print(type(section_number))
     sections = [sec.strip() for sec in section_number.split(",")]
-    db = client['Indian_Acts']
     section_desc = list()
     for col in collection_name:
-        collection = db[col]
-        
-        query = {'Section_Number': {'$in': sections}}
-        results = collection.find(query)
-        for res in results:
+        for res in section_index.find(col, sections):
             section_desc.append(res['Description'])
     return section_desc
-    
+
+async def aget_desc(collection_name: list, section_number: str):
+    # The first lookup in a worker may still read Mongo, keep it off the event loop
+    return await run_blocking(get_desc, collection_name, section_number)
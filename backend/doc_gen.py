@@ -2,6 +2,10 @@ import os
 import logging
 import sys
 import re
+import shutil
+import tempfile
+import threading
+from functools import partial
 import templates as tm
 
 
@@ -10,14 +14,17 @@ from llama_index.core.indices.vector_store.retrievers.retriever import VectorInd
 from llama_index.core.vector_stores.types import VectorStoreQueryMode
 from llama_index.core import VectorStoreIndex
 from llama_index.core.tools import QueryEngineTool, ToolMetadata
-from llama_index.core.schema import IndexNode
+from llama_index.core.schema import IndexNode, QueryBundle
 from llama_index.core.retrievers import RecursiveRetriever
 from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.response.schema import Response
+from llama_index.core.memory import ChatMemoryBuffer
 from llama_index.core import get_response_synthesizer
 from llama_index.agent.openai import OpenAIAgent
 from llama_index.llms.azure_openai import AzureOpenAI as op1
 
-from typing import List, Union
+from typing import Any, List, Union
 
 from langchain.agents import AgentExecutor, create_react_agent
 from langchain_openai import AzureChatOpenAI
@@ -26,47 +33,54 @@ from langchain_core.tools import Tool
 
 from templates import template1
 import utils
+import telemetry
+from registry import DOC_ACTS, registry
+from concurrency import run_blocking
+from streaming import LangChainEvents, stream_query
+from tracing import agent_config
+from query_rewrite import QUERY_REWRITE, rewrite as rewrite_query
 
-def preprocessing(query: str):
-    names = ["The Indian Contract Act, 1872","The Specific Relief Act, 1963","The Transfer of Property Act, 1882", "The Uttar Pradesh Urban Buildings (Regulation of Letting, Rent and Eviction) Act, 1972", "The Right to Information Act, 2005"]
-    descriptions = ["The go-to document for Contract Rules. The Indian Contract Act, 1872 is a fundamental legal framework in India that governs the formation and enforcement of contracts, defining the rules and principles that underlie agreements between parties in various transactions.", "The go-to document for Relief Rules. The Specific Relief Act, 1963 is an Indian legal statute that governs the remedies available for the enforcement of civil rights and obligations, emphasizing the specific performance of contracts as a primary remedy.", "The go-to document for Rules for transferring property and its rights. The Transfer of Property Act, 1882 is a legal statute in India that governs the transfer of property from one person to another. It defines various types of property transactions, including sales, mortgages, leases, and gifts, and sets out the legal rules and procedures for such transfers.", "The go-to document for Rules and Regulations for Rent in Uttar Pradesh. The Uttar Pradesh Urban Buildings Act of 1972 regulates the rental and eviction of urban properties in the Indian state of Uttar Pradesh", "The Right to Information Act (RTI) of 2005 empowers Indian citizens to request information from public authorities to promote transparency and accountability. It mandates a response within 30 days, with exemptions for national security and personal privacy. It includes appeal mechanisms and penalties for non-compliance."]
-    temp = ['ica', 'sra', 'tpa', 'upra', 'rti']
 
-    agents = {}
+names = ["The Indian Contract Act, 1872","The Specific Relief Act, 1963","The Transfer of Property Act, 1882", "The Uttar Pradesh Urban Buildings (Regulation of Letting, Rent and Eviction) Act, 1972", "The Right to Information Act, 2005"]
+descriptions = ["The go-to document for Contract Rules. The Indian Contract Act, 1872 is a fundamental legal framework in India that governs the formation and enforcement of contracts, defining the rules and principles that underlie agreements between parties in various transactions.", "The go-to document for Relief Rules. The Specific Relief Act, 1963 is an Indian legal statute that governs the remedies available for the enforcement of civil rights and obligations, emphasizing the specific performance of contracts as a primary remedy.", "The go-to document for Rules for transferring property and its rights. The Transfer of Property Act, 1882 is a legal statute in India that governs the transfer of property from one person to another. It defines various types of property transactions, including sales, mortgages, leases, and gifts, and sets out the legal rules and procedures for such transfers.", "The go-to document for Rules and Regulations for Rent in Uttar Pradesh. The Uttar Pradesh Urban Buildings Act of 1972 regulates the rental and eviction of urban properties in the Indian state of Uttar Pradesh", "The Right to Information Act (RTI) of 2005 empowers Indian citizens to request information from public authorities to promote transparency and accountability. It mandates a response within 30 days, with exemptions for national security and personal privacy. It includes appeal mechanisms and penalties for non-compliance."]
+temp = ['ica', 'sra', 'tpa', 'upra', 'rti']
 
-    for n,x in enumerate(temp):
-        storage_context = StorageContext.from_defaults(persist_dir=x)
-        
-        vector_index = load_index_from_storage(storage_context=storage_context, index_id="vector_index")
-        summary_index = load_index_from_storage(storage_context=storage_context, index_id="vector_index")
-        
-        vector_query_engine = vector_index.as_query_engine()
-        list_query_engine = summary_index.as_query_engine()
-        
-        query_engine_tools = [
-            QueryEngineTool(
-                query_engine = vector_query_engine,
-                metadata = ToolMetadata(name = temp[n],description= descriptions[n])
-            ),
-            QueryEngineTool(
-                query_engine = list_query_engine,
-                metadata =  ToolMetadata(name = temp[n], description= descriptions[n])
-            )
-        ]
-        function_llm = op1(
-            azure_endpoint=os.environ['AZURE_ENDPOINT'],
-            api_key=os.environ['AZURE_API_KEY'],
-            api_version=os.environ['AZURE_VERSION'],
-            azure_deployment="agile4",
-            model='gpt-4',
-        )
-        agent = OpenAIAgent.from_tools(
-            query_engine_tools,
-            llm=function_llm,
-            verbose=True,
-        )
-        agents[x] = agent
+ROUTER_DIR = os.environ.get("DOC_ROUTER_DIR", "doc_router")
+
+logger = telemetry.get_logger("doc_gen")
+
+_lock = threading.Lock()
+_shared = {}
+
+
+def _cached(key, build):
+    with _lock:
+        if key not in _shared:
+            _shared[key] = build()
+        return _shared[key]
 
+
+def _azure_llm():
+    return op1(
+        azure_endpoint=os.environ['AZURE_ENDPOINT'],
+        api_key=os.environ['AZURE_API_KEY'],
+        api_version=os.environ['AZURE_VERSION'],
+        azure_deployment="agile4",
+        model='gpt-4',
+    )
+
+
+def _agent_llm():
+    return AzureChatOpenAI(
+        azure_endpoint=os.environ['AZURE_ENDPOINT'],
+        api_key=os.environ['AZURE_API_KEY'],
+        api_version=os.environ['AZURE_VERSION'],
+        azure_deployment="agile4",
+        model='gpt-4',
+    )
+
+
+def _router_nodes():
     nodes = []
     for n,x in enumerate(names):
         act_summary = (
@@ -76,30 +90,191 @@ def preprocessing(query: str):
         )
         node = IndexNode(text=act_summary, index_id=temp[n])
         nodes.append(node)
+    return nodes
 
-    vector_index = VectorStoreIndex(nodes)
-    vector_retriever = vector_index.as_retriever(similarity_top_k=1)
 
-    recursive_retriever = RecursiveRetriever(
-        "vector",
-        retriever_dict={"vector": vector_retriever},
-        query_engine_dict=agents,
-        verbose=True,
-    )
+def _load_router_index(nodes):
+    try:
+        storage_context = StorageContext.from_defaults(persist_dir=ROUTER_DIR)
+        index = load_index_from_storage(storage_context=storage_context)
+    except (OSError, ValueError):
+        # Missing, or left half written by an older version
+        return None
+    persisted = sorted(node.get_content() for node in index.docstore.docs.values())
+    if persisted == sorted(node.get_content() for node in nodes):
+        return index
+    return None
+
+
+def _persist_router_index(index):
+    # Persist into a sibling directory and rename it into place, readers see the old index or the new one
+    parent = os.path.dirname(os.path.abspath(ROUTER_DIR))
+    try:
+        staging = tempfile.mkdtemp(prefix=".doc_router.", dir=parent)
+    except OSError as e:
+        logger.warning("doc router index not persisted, %s is not writable: %s", parent, e)
+        return
+    try:
+        index.storage_context.persist(persist_dir=staging)
+        if os.path.exists(ROUTER_DIR):
+            stale = tempfile.mkdtemp(prefix=".doc_router.", dir=parent)
+            os.replace(ROUTER_DIR, os.path.join(stale, "old"))
+            shutil.rmtree(stale, ignore_errors=True)
+        os.rename(staging, ROUTER_DIR)
+    except OSError as e:
+        # Another worker renamed its copy in first, the embeddings are the same
+        logger.info("doc router index already persisted: %s", e)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def _router_index():
+    nodes = _router_nodes()
+    index = _load_router_index(nodes) if os.path.exists(ROUTER_DIR) else None
+    if index is not None:
+        return index
+
+    # Embeds the act summaries once, later workers load the persisted embeddings
+    index = VectorStoreIndex(nodes)
+    _persist_router_index(index)
+    return index
+
 
-    response_synthesizer = get_response_synthesizer(
+def router_retriever():
+    return _cached("router_retriever", lambda: _router_index().as_retriever(similarity_top_k=1))
+
+
+def function_llm():
+    return _cached("function_llm", _azure_llm)
+
+
+def response_synthesizer(streaming: bool = False):
+    return _cached(("response_synthesizer", streaming), lambda: get_response_synthesizer(
         # service_context=service_context,
         response_mode="compact",
+        streaming=streaming,
+    ))
+
+
+class _NoMemory(ChatMemoryBuffer):
+    # The act agents are shared by every request, nothing one question says may reach the next
+    def get(self, *args: Any, **kwargs: Any):
+        return []
+
+    def get_all(self):
+        return []
+
+    def put(self, message):
+        pass
+
+    def put_messages(self, messages):
+        pass
+
+    def set(self, messages):
+        pass
+
+
+class ActAgent(BaseQueryEngine):
+    # Runs each question as its own task on a shared OpenAIAgent and deletes the task afterwards,
+    # AgentRunner.query would keep every finished task in its state
+    def __init__(self, agent: OpenAIAgent) -> None:
+        self._agent = agent
+        super().__init__(callback_manager=agent.callback_manager)
+
+    def _get_prompt_modules(self):
+        return {}
+
+    def _response(self, task_id):
+        response = self._agent.finalize_response(task_id)
+        return Response(response=str(response), source_nodes=response.source_nodes)
+
+    def _query(self, query_bundle: QueryBundle):
+        task = self._agent.create_task(query_bundle.query_str)
+        try:
+            while not self._agent.run_step(task.task_id).is_last:
+                pass
+            return self._response(task.task_id)
+        finally:
+            self._agent.delete_task(task.task_id)
+
+    async def _aquery(self, query_bundle: QueryBundle):
+        task = self._agent.create_task(query_bundle.query_str)
+        try:
+            while not (await self._agent.arun_step(task.task_id)).is_last:
+                pass
+            return self._response(task.task_id)
+        finally:
+            self._agent.delete_task(task.task_id)
+
+
+def _act_agent(n: int, x: str):
+    # Specific facts come from the act's vector index, whole-act questions from a summary over every chunk
+    index = registry.index(x)
+    query_engine_tools = [
+        QueryEngineTool(
+            query_engine=registry.query_engine(x),
+            metadata=ToolMetadata(
+                name=f"{x}_vector",
+                description=f"Useful for questions about specific provisions, sections or facts of {names[n]}. {descriptions[n]}",
+            ),
+        ),
+        QueryEngineTool(
+            query_engine=SummaryIndex(list(index.docstore.docs.values())).as_query_engine(response_mode="tree_summarize", llm=function_llm()),
+            metadata=ToolMetadata(
+                name=f"{x}_summary",
+                description=f"Useful for summarizing or comparing across the whole of {names[n]}, not for single sections.",
+            ),
+        ),
+    ]
+    agent = OpenAIAgent.from_tools(query_engine_tools, llm=function_llm(), memory=_NoMemory.from_defaults())
+    return ActAgent(agent)
+
+
+def agents():
+    # Built once per loaded version of each act, an ingest or reload swaps in a new agent
+    agents = {}
+    for n, x in enumerate(temp):
+        registry.index(x)
+        version = registry.version(x)
+        with _lock:
+            cached = _shared.get(("act_agent", x))
+        if cached is None or cached[0] != version:
+            cached = (version, _act_agent(n, x))
+            with _lock:
+                _shared[("act_agent", x)] = cached
+        agents[x] = cached[1]
+    return agents
+
+
+def warm_up():
+    router_retriever()
+    function_llm()
+    response_synthesizer()
+    agents()
+
+
+def query_engine(streaming: bool = False):
+    recursive_retriever = RecursiveRetriever(
+        "vector",
+        retriever_dict={"vector": router_retriever()},
+        query_engine_dict=agents(),
     )
-    query_engine = RetrieverQueryEngine.from_args(
+
+    return RetrieverQueryEngine.from_args(
         recursive_retriever,
-        response_synthesizer=response_synthesizer,
+        response_synthesizer=response_synthesizer(streaming),
     )
 
+
+def agent_executor(streaming: bool = False):
+    engine = query_engine(streaming)
+
     tools = [
         Tool(
             name = "Llama-Index",
-            func = query_engine.query,
+            func = partial(stream_query, engine) if streaming else engine.query,
+            # RecursiveRetriever has no async path, keep its sync calls off the event loop
+            coroutine = partial(run_blocking, partial(stream_query, engine) if streaming else engine.query),
             description = f"Useful for when you want to extract content. The input to this tool should be a complete English sentence. Works best if you redirect the entire query back into this.",
             return_direct = True
         )
@@ -111,21 +286,36 @@ def preprocessing(query: str):
     )
 
 
-    llm = AzureChatOpenAI(
-            azure_endpoint=os.environ['AZURE_ENDPOINT'],
-            api_key=os.environ['AZURE_API_KEY'],
-            api_version=os.environ['AZURE_VERSION'],
-            azure_deployment="agile4",
-            model='gpt-4',
-        )
-
     agent = create_react_agent(
-        llm=llm,
+        llm=_cached("agent_llm", _agent_llm),
         tools=tools,
         prompt=prompt,
     )
 
-    agent_executor = AgentExecutor.from_agent_and_tools(agent=agent, tools=tools, verbose=True, return_intermediate_steps=True)
+    return AgentExecutor.from_agent_and_tools(agent=agent, tools=tools, return_intermediate_steps=True)
+
+def preprocessing(query: str):
+    return agent_executor().invoke({"input":query}, config=agent_config())
+
+async def apreprocessing(query: str):
+    executor = await run_blocking(agent_executor)
+    return await executor.ainvoke({"input":query}, config=agent_config())
+
+async def astream_preprocessing(query: str):
+    executor = await run_blocking(agent_executor, streaming=True)
+    return await executor.ainvoke({"input":query}, config=agent_config(LangChainEvents()))
+
+# Direct mode skips the ReAct agent, its only step was handing the query to the tool
+def direct(query: str, rewrite: bool = QUERY_REWRITE):
+    question = rewrite_query(query, DOC_ACTS) if rewrite else query
+    return {"input": query, "output": query_engine().query(question)}
+
+async def adirect(query: str, rewrite: bool = QUERY_REWRITE):
+    question = rewrite_query(query, DOC_ACTS) if rewrite else query
+    engine = await run_blocking(query_engine)
+    return {"input": query, "output": await run_blocking(engine.query, question)}
 
-    return agent_executor.invoke({"input":query})
-    
\ No newline at end of file
+async def astream_direct(query: str, rewrite: bool = QUERY_REWRITE):
+    question = rewrite_query(query, DOC_ACTS) if rewrite else query
+    engine = await run_blocking(query_engine, streaming=True)
+    return {"input": query, "output": await run_blocking(stream_query, engine, question)}
@@ -0,0 +1,217 @@
+import os
+import re
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+from typing import Any, List
+
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+from singleflight import SingleFlight
+
+EMBED_CACHE_PATH = os.environ.get("EMBED_CACHE_PATH", "embed_cache.sqlite3")
+EMBED_CACHE_MEMORY_SIZE = int(os.environ.get("EMBED_CACHE_MEMORY_SIZE", 4096))
+EMBED_CACHE_DISK_SIZE = int(os.environ.get("EMBED_CACHE_DISK_SIZE", 200000))
+# Disk hits refresh used_at at most this often, and the refreshes are written in batches
+EMBED_CACHE_TOUCH_INTERVAL = float(os.environ.get("EMBED_CACHE_TOUCH_INTERVAL", 10 * 60))
+EMBED_CACHE_TOUCH_BATCH = 256
+
+# The same question arriving at once is embedded by one request, the rest wait for it
+embedding_flight = SingleFlight("embedding")
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+class EmbeddingCache:
+    def __init__(self, path: str = EMBED_CACHE_PATH, memory_size: int = EMBED_CACHE_MEMORY_SIZE, disk_size: int = EMBED_CACHE_DISK_SIZE) -> None:
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._touched = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self.path = path
+        self._db = None
+        self._pid = None
+
+    def _connection(self):
+        # Opened on first use in each process, a connection made before a fork must not be shared
+        if not self.path:
+            return None
+        if self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._pid = os.getpid()
+            self._touched = {}
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_used_at ON embeddings (used_at)")
+            self._db.commit()
+            self._count = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return self._db
+
+    def key(self, model_name: str, text: str, kind: str = "text") -> str:
+        # kind is "query" or "text", models with separate query and document embeddings return different vectors
+        return hashlib.sha256(f"{model_name}\x00{kind}\x00{normalize_text(text)}".encode()).hexdigest()
+
+    def _remember(self, key: str, embedding: Embedding):
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str):
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return embedding
+
+            db = self._connection()
+            if db is not None:
+                row = db.execute("SELECT vector, used_at FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    embedding = np.frombuffer(row[0], dtype=np.float32).tolist()
+                    now = time.time()
+                    if now - row[1] > EMBED_CACHE_TOUCH_INTERVAL:
+                        self._touched[key] = now
+                        if len(self._touched) >= EMBED_CACHE_TOUCH_BATCH:
+                            self._flush_touched()
+                            db.commit()
+                    self._remember(key, embedding)
+                    self.disk_hits += 1
+                    return embedding
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, embedding: Embedding):
+        with self._lock:
+            self._remember(key, embedding)
+            db = self._connection()
+            if db is None:
+                return
+            vector = np.asarray(embedding, dtype=np.float32).tobytes()
+            now = time.time()
+            inserted = db.execute(
+                "INSERT OR IGNORE INTO embeddings (key, vector, used_at) VALUES (?, ?, ?)", (key, vector, now)
+            ).rowcount
+            if inserted:
+                self._count += 1
+            else:
+                db.execute("UPDATE embeddings SET vector = ?, used_at = ? WHERE key = ?", (vector, now, key))
+            self._flush_touched()
+            if self._count > self.disk_size:
+                self._evict()
+            db.commit()
+
+    def _flush_touched(self):
+        if self._touched:
+            self._db.executemany("UPDATE embeddings SET used_at = ? WHERE key = ?", [(t, k) for k, t in self._touched.items()])
+            self._touched = {}
+
+    def _evict(self):
+        # Other workers insert into the same file, recount only when the running count says it is full
+        self._count = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if self._count > self.disk_size:
+            # Evicting a little extra keeps the next inserts from evicting one row each
+            overflow = self._count - self.disk_size + self.disk_size // 100
+            self._db.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY used_at LIMIT ?)",
+                (overflow,),
+            )
+            self._count -= overflow
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+        }
+
+
+class CachedEmbedding(BaseEmbedding):
+    _model: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+
+    def __init__(self, model: BaseEmbedding, cache: EmbeddingCache = None, **kwargs: Any) -> None:
+        super().__init__(
+            model_name=model.model_name,
+            embed_batch_size=model.embed_batch_size,
+            callback_manager=model.callback_manager,
+            **kwargs,
+        )
+        self._model = model
+        self._cache = cache or EmbeddingCache()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def cache(self) -> EmbeddingCache:
+        return self._cache
+
+    @property
+    def uncached(self) -> BaseEmbedding:
+        return self._model
+
+    def _cached(self, texts: List[str], kind: str = "text"):
+        keys = [self._cache.key(self.model_name, text, kind) for text in texts]
+        embeddings = [self._cache.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        return keys, embeddings, missing
+
+    def _store(self, keys, embeddings, missing, computed):
+        for i, embedding in zip(missing, computed):
+            self._cache.put(keys[i], embedding)
+            embeddings[i] = embedding
+        return embeddings
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        keys, embeddings, missing = self._cached([query], "query")
+        if missing:
+            computed = embedding_flight.do_blocking(keys[0], lambda: self._model._get_query_embedding(query))
+            return self._store(keys, embeddings, missing, [computed])[0]
+        return embeddings[0]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        keys, embeddings, missing = self._cached([query], "query")
+        if missing:
+            computed = await embedding_flight.do(keys[0], lambda: self._model._aget_query_embedding(query))
+            return self._store(keys, embeddings, missing, [computed])[0]
+        return embeddings[0]
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        keys, embeddings, missing = self._cached(texts)
+        if missing:
+            computed = self._model._get_text_embeddings([texts[i] for i in missing])
+            self._store(keys, embeddings, missing, computed)
+        return embeddings
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        keys, embeddings, missing = self._cached(texts)
+        if missing:
+            computed = await self._model._aget_text_embeddings([texts[i] for i in missing])
+            self._store(keys, embeddings, missing, computed)
+        return embeddings
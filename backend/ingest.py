@@ -0,0 +1,209 @@
+import os
+import json
+import shutil
+import asyncio
+import hashlib
+import argparse
+
+from llama_index.core import SimpleDirectoryReader, StorageContext, VectorStoreIndex, Settings
+from llama_index.core.schema import MetadataMode
+from llama_index.core.storage.docstore import SimpleDocumentStore
+from llama_index.vector_stores.faiss import FaissVectorStore
+
+import utils
+import lexical
+import persist
+from embed_cache import CachedEmbedding
+from mmap_store import convert, has_mmap_store, is_json_store, nodes_dict, read_persisted
+from quantize import MODES, has_quantized, quantize
+
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 64))
+INGEST_CONCURRENCY = int(os.environ.get("INGEST_CONCURRENCY", 4))
+DEFAULT_INDEX_ID = "vector_index"
+
+
+def content_key(node) -> str:
+    # Hash of exactly what gets embedded, so metadata-only changes don't cost an embedding call
+    return hashlib.sha256(node.get_content(metadata_mode=MetadataMode.EMBED).encode("utf-8", "surrogatepass")).hexdigest()
+
+
+class Existing:
+    def __init__(self, persist_dir: str) -> None:
+        self.docstore = None
+        self.index_id = DEFAULT_INDEX_ID
+        self.faiss = False
+        self.embeddings = {}
+        self.by_hash = {}
+        self.by_content = {}
+        if not os.path.exists(os.path.join(persist_dir, "docstore.json")):
+            return
+
+        self.docstore = SimpleDocumentStore.from_persist_dir(persist_dir)
+        with open(os.path.join(persist_dir, "index_store.json")) as f:
+            self.index_id = next(iter(json.load(f)["index_store/data"]))
+        self.faiss = not is_json_store(persist_dir)
+
+        nodes = nodes_dict(persist_dir)
+        ids, matrix = read_persisted(persist_dir)
+        for vector_id, embedding in zip(ids, matrix):
+            self.embeddings[nodes[vector_id]] = embedding.tolist()
+
+        for node_id in self.embeddings:
+            node = self.docstore.docs.get(node_id)
+            if node is None:
+                continue
+            self.by_hash[self.docstore.get_document_hash(node_id)] = node
+            self.by_content[content_key(node)] = self.embeddings[node_id]
+
+    def unchanged_nodes(self, document):
+        # Documents keep their id across runs when read with filename_as_id
+        if self.docstore is None or self.docstore.get_document_hash(document.doc_id) != document.hash:
+            return None
+        ref_doc_info = self.docstore.get_ref_doc_info(document.doc_id)
+        if ref_doc_info is None or any(node_id not in self.embeddings for node_id in ref_doc_info.node_ids):
+            return None
+        nodes = self.docstore.get_nodes(ref_doc_info.node_ids)
+        for node in nodes:
+            node.embedding = self.embeddings[node.node_id]
+        return nodes
+
+
+class Checkpoint:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.embeddings = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        # A run killed mid-write leaves a partial last line
+                        continue
+                    self.embeddings[row["key"]] = row["embedding"]
+
+    def save(self, keys, embeddings):
+        with open(self.path, "a") as f:
+            for key, embedding in zip(keys, embeddings):
+                f.write(json.dumps({"key": key, "embedding": embedding}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.embeddings.update(zip(keys, embeddings))
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+async def embed(pending: dict, checkpoint: Checkpoint, batch_size: int = INGEST_BATCH_SIZE, concurrency: int = INGEST_CONCURRENCY):
+    keys = list(pending)
+    semaphore = asyncio.Semaphore(concurrency)
+    # Chunks are reused through the checkpoint and content hashes, they would only push queries out of the embedding cache
+    embed_model = Settings.embed_model
+    if isinstance(embed_model, CachedEmbedding):
+        embed_model = embed_model.uncached
+
+    async def run(batch):
+        async with semaphore:
+            embeddings = await embed_model.aget_text_embedding_batch([pending[key] for key in batch])
+        checkpoint.save(batch, embeddings)
+        print(f"embedded {len(checkpoint.embeddings)} chunks")
+
+    await asyncio.gather(*(run(keys[i:i + batch_size]) for i in range(0, len(keys), batch_size)))
+
+
+def _nodes(documents, existing: Existing, checkpoint: Checkpoint):
+    nodes = []
+    changed = []
+    for document in documents:
+        unchanged = existing.unchanged_nodes(document)
+        if unchanged is None:
+            changed.append(document)
+        else:
+            nodes.extend(unchanged)
+
+    pending = {}
+    for node in Settings.node_parser.get_nodes_from_documents(changed):
+        previous = existing.by_hash.get(node.hash)
+        if previous is not None and previous.node_id in existing.embeddings:
+            node.id_ = previous.node_id
+            node.embedding = existing.embeddings[previous.node_id]
+        nodes.append(node)
+        if node.embedding is None:
+            key = content_key(node)
+            if key not in existing.by_content and key not in checkpoint.embeddings:
+                pending[key] = node.get_content(metadata_mode=MetadataMode.EMBED)
+    return nodes, pending
+
+
+def _write(persist_dir: str, nodes, documents, existing: Existing, faiss_store: bool, mmap: bool):
+    # Every file goes into a fresh version directory, the registry sees it only once CURRENT points at it
+    version_dir = persist.new_version(persist_dir)
+    try:
+        if faiss_store:
+            import faiss
+            vector_store = FaissVectorStore(faiss_index=faiss.IndexFlatL2(len(nodes[0].embedding)))
+            storage_context = StorageContext.from_defaults(vector_store=vector_store)
+        else:
+            storage_context = StorageContext.from_defaults()
+        index = VectorStoreIndex(nodes, storage_context=storage_context)
+        index.set_index_id(existing.index_id)
+        storage_context.docstore.set_document_hashes({document.doc_id: document.hash for document in documents})
+        storage_context.persist(persist_dir=version_dir)
+        if mmap:
+            convert(version_dir)
+        # Built here so serving workers only read it
+        lexical.load(version_dir, index.index_struct.nodes_dict)
+        # Compressed indexes cover the old rows, rebuild each one the current version has
+        previous_dir = persist.resolve(persist_dir)
+        for mode in MODES:
+            if has_quantized(previous_dir, mode):
+                quantize(version_dir, mode)
+    except BaseException:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+    persist.publish(persist_dir, version_dir)
+
+
+def ingest(persist_dir: str, sources: list, faiss_store: bool = None, batch_size: int = INGEST_BATCH_SIZE, concurrency: int = INGEST_CONCURRENCY):
+    existing = Existing(persist.resolve(persist_dir))
+    if faiss_store is None:
+        faiss_store = existing.faiss
+    mmap = has_mmap_store(persist.resolve(persist_dir))
+    checkpoint = Checkpoint(persist_dir.rstrip("/\\") + ".ingest.jsonl")
+
+    documents = []
+    for source in sources:
+        if os.path.isdir(source):
+            reader = SimpleDirectoryReader(input_dir=source, recursive=True, filename_as_id=True)
+        else:
+            reader = SimpleDirectoryReader(input_files=[source], filename_as_id=True)
+        documents.extend(reader.load_data())
+
+    nodes, pending = _nodes(documents, existing, checkpoint)
+    reused = len(nodes) - len(pending)
+    print(f"{persist_dir}: {len(nodes)} chunks, {reused} reused, {len(pending)} to embed")
+    if pending:
+        asyncio.run(embed(pending, checkpoint, batch_size, concurrency))
+
+    for node in nodes:
+        if node.embedding is None:
+            key = content_key(node)
+            node.embedding = existing.by_content.get(key) or checkpoint.embeddings[key]
+
+    if nodes:
+        _write(persist_dir, nodes, documents, existing, faiss_store, mmap)
+    checkpoint.remove()
+    return {"chunks": len(nodes), "reused": reused, "embedded": len(pending)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chunk act texts and update a persisted index, embedding only new or changed chunks")
+    parser.add_argument("persist_dir", help="e.g. storage/mva or ica")
+    parser.add_argument("sources", nargs="+", help="every source file or directory for the act, chunks of sources left out are dropped")
+    parser.add_argument("--faiss", action="store_true", default=None, help="write a faiss store, the default for an existing index is its current format")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=INGEST_CONCURRENCY)
+    args = parser.parse_args()
+
+    print(ingest(args.persist_dir, args.sources, args.faiss, args.batch_size, args.concurrency))
@@ -0,0 +1,169 @@
+import os
+import re
+import json
+import tempfile
+import numpy as np
+from collections import Counter
+
+import telemetry
+
+LEXICAL_FILE = "default__lexical.npz"
+LEXICAL_FAST_PATH_RATIO = float(os.environ.get("LEXICAL_FAST_PATH_RATIO", 0.6))
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+logger = telemetry.get_logger("lexical")
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i", "in", "is",
+    "it", "me", "of", "on", "or", "say", "says", "tell", "that", "the", "this", "to", "under", "what", "which",
+    "who", "with",
+}
+# Words that only make sense next to a number, "section 185" is as lexical as "185"
+IDENTIFIER_WORDS = {"section", "sections", "sec", "s", "ss", "u", "form", "rule", "rules", "schedule", "chapter", "clause", "article", "sub"}
+
+
+def tokenize(text: str) -> list:
+    return re.findall(r"[a-z]+|\d+[a-z]*", text.lower())
+
+
+def identifiers(query: str) -> list:
+    return [token for token in tokenize(query) if token[0].isdigit()]
+
+
+def is_lexical(query: str, ratio: float = LEXICAL_FAST_PATH_RATIO) -> bool:
+    tokens = [token for token in tokenize(query) if token not in STOPWORDS]
+    if not any(token[0].isdigit() for token in tokens):
+        return False
+    identifiers = [token for token in tokens if token[0].isdigit() or token in IDENTIFIER_WORDS]
+    return len(identifiers) / len(tokens) >= ratio
+
+
+class BM25Index:
+    def __init__(self, ids, vocab, indptr, docs, tfs, doc_len, source=None) -> None:
+        self.ids = list(ids)
+        self.terms = list(vocab)
+        self.vocab = {term: i for i, term in enumerate(self.terms)}
+        self.indptr = indptr
+        self.docs = docs
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.source = source
+        avg_len = float(doc_len.mean()) if len(doc_len) else 1.0
+        self._norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len / (avg_len or 1.0))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, ids, texts, source=None) -> "BM25Index":
+        postings = {}
+        doc_len = np.zeros(len(texts), dtype=np.int32)
+        for doc, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_len[doc] = sum(counts.values())
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((doc, tf))
+
+        vocab = sorted(postings)
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        docs = []
+        tfs = []
+        for i, term in enumerate(vocab):
+            for doc, tf in postings[term]:
+                docs.append(doc)
+                tfs.append(min(tf, 65535))
+            indptr[i + 1] = len(docs)
+        return cls(ids, vocab, indptr, np.asarray(docs, dtype=np.int32), np.asarray(tfs, dtype=np.uint16), doc_len, source)
+
+    def scores(self, query: str):
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term in set(tokenize(query)) - STOPWORDS:
+            col = self.vocab.get(term)
+            if col is None:
+                continue
+            start, end = self.indptr[col], self.indptr[col + 1]
+            docs = self.docs[start:end]
+            tf = self.tfs[start:end].astype(np.float32)
+            idf = np.log(1 + (len(self.ids) - (end - start) + 0.5) / ((end - start) + 0.5))
+            scores[docs] += idf * tf * (BM25_K1 + 1) / (tf + self._norm[docs])
+        return scores
+
+    def search(self, query: str, k: int):
+        scores = self.scores(query)
+        matched = int(np.count_nonzero(scores))
+        k = min(k, matched)
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[i], float(scores[i])) for i in top]
+
+    def save(self, path: str):
+        # A unique temp name, workers loading the same index at once each write their own copy
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path) or ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez_compressed(
+                    f,
+                    ids=np.asarray(self.ids, dtype=str),
+                    vocab=np.asarray(self.terms, dtype=str),
+                    indptr=self.indptr,
+                    docs=self.docs,
+                    tfs=self.tfs,
+                    doc_len=self.doc_len,
+                    source=np.asarray(self.source, dtype=np.int64),
+                )
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def read(cls, path: str) -> "BM25Index":
+        with np.load(path) as data:
+            return cls(
+                data["ids"].tolist(), data["vocab"].tolist(), data["indptr"], data["docs"],
+                data["tfs"], data["doc_len"], tuple(data["source"].tolist()),
+            )
+
+
+def _source(persist_dir: str):
+    stat = os.stat(os.path.join(persist_dir, "docstore.json"))
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def load(persist_dir: str, nodes_dict: dict) -> BM25Index:
+    # Rebuilt whenever docstore.json changes, e.g. after an ingest run
+    path = os.path.join(persist_dir, LEXICAL_FILE)
+    source = _source(persist_dir)
+    if os.path.exists(path):
+        index = BM25Index.read(path)
+        if index.source == source:
+            return index
+
+    with open(os.path.join(persist_dir, "docstore.json")) as f:
+        data = json.load(f)["docstore/data"]
+    ids = []
+    texts = []
+    for vector_id, node_id in nodes_dict.items():
+        if node_id in data:
+            ids.append(vector_id)
+            texts.append(data[node_id]["__data__"].get("text", ""))
+
+    index = BM25Index.build(ids, texts, source)
+    try:
+        index.save(path)
+    except OSError as e:
+        # Read-only index dirs rebuild in memory on every load, ingest writes the file next to the index
+        logger.warning("lexical index kept in memory, could not write %s: %s", path, e)
+    return index
+
+
+def fuse(rankings, k: int, rrf_k: int = 60):
+    # Reciprocal rank fusion, only ranks matter so BM25 and cosine scores need no calibration
+    scores = {}
+    for ranking in rankings:
+        for rank, (vector_id, _) in enumerate(ranking):
+            scores[vector_id] = scores.get(vector_id, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(scores.items(), key=lambda item: -item[1])[:k]
@@ -0,0 +1,88 @@
+import os
+import time
+import signal
+import asyncio
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+import telemetry
+from concurrency import run_blocking
+
+# How long a request that arrives during warm-up waits before it gets a 503
+READY_WAIT = float(os.environ.get("READY_WAIT", 30))
+# A failing warm-up step is retried with doubling delays, then the worker exits so the supervisor restarts it
+READY_RETRIES = int(os.environ.get("READY_RETRIES", 5))
+READY_RETRY_DELAY = float(os.environ.get("READY_RETRY_DELAY", 2))
+READY_RETRY_MAX_DELAY = 60
+
+logger = telemetry.get_logger("lifecycle")
+
+
+class Lifecycle:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.steps = {}
+        self.error = None
+        self._ready = asyncio.Event()
+        self._task = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    async def _step(self, name, step):
+        for attempt in range(READY_RETRIES + 1):
+            try:
+                # Steps import the heavy modules themselves, keep that off the event loop
+                await run_blocking(step)
+                self.error = None
+                return True
+            except Exception:
+                # Only the step name is public, the exception goes to the log
+                self.error = name
+                logger.exception("%s warm-up failed at %s (%s/%s)", self.name, name, attempt + 1, READY_RETRIES + 1)
+            if attempt < READY_RETRIES:
+                await asyncio.sleep(min(READY_RETRY_DELAY * 2 ** attempt, READY_RETRY_MAX_DELAY))
+        return False
+
+    async def _run(self, steps):
+        started = time.perf_counter()
+        for name, step in steps:
+            start = time.perf_counter()
+            if not await self._step(name, step):
+                logger.error("%s warm-up gave up at %s, shutting the worker down", self.name, name)
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+            self.steps[name] = time.perf_counter() - start
+            telemetry.record(f"warm_up_{name}", start, self.steps[name])
+        self._ready.set()
+        logger.info("%s ready in %.2fs", self.name, time.perf_counter() - started)
+
+    def start(self, steps):
+        # Runs in the background so /healthz answers while the worker warms up
+        self._task = asyncio.create_task(self._run(steps))
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def wait(self):
+        if self.error is not None:
+            raise HTTPException(status_code=503, detail=f"warm-up failed at {self.error}")
+        try:
+            await asyncio.wait_for(self._ready.wait(), READY_WAIT)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="warming up")
+
+    def status(self) -> dict:
+        return {"ready": self.ready, "error": self.error, "steps": self.steps}
+
+    def routes(self, app):
+        @app.get("/healthz", include_in_schema=False)
+        async def healthz():
+            return {"ok": True}
+
+        @app.get("/readyz", include_in_schema=False)
+        async def readyz():
+            return JSONResponse(content=self.status(), status_code=200 if self.ready else 503)
@@ -0,0 +1,142 @@
+import os
+import sys
+import json
+import numpy as np
+from typing import Any, List
+
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+
+import persist
+from retrieval import top_k
+
+MATRIX_FILE = "default__vector_store.npy"
+IDS_FILE = "default__vector_store.ids.json"
+JSON_FILE = "default__vector_store.json"
+
+
+class ReadOnlyStoreError(TypeError):
+    pass
+
+
+def has_mmap_store(persist_dir: str) -> bool:
+    return os.path.exists(os.path.join(persist_dir, MATRIX_FILE)) and os.path.exists(os.path.join(persist_dir, IDS_FILE))
+
+
+def nodes_dict(persist_dir: str) -> dict:
+    # Maps the vector store id of every row the index uses to its node id
+    with open(os.path.join(persist_dir, "index_store.json")) as f:
+        index_store = json.load(f)["index_store/data"]
+    nodes = {}
+    for index_struct in index_store.values():
+        nodes.update(json.loads(index_struct["__data__"]).get("nodes_dict", {}))
+    return nodes
+
+
+def is_json_store(persist_dir: str) -> bool:
+    with open(os.path.join(persist_dir, JSON_FILE), "rb") as f:
+        return f.read(1) == b"{"
+
+
+def read_persisted(persist_dir: str):
+    path = os.path.join(persist_dir, JSON_FILE)
+    if is_json_store(persist_dir):
+        with open(path) as f:
+            embedding_dict = json.load(f)["embedding_dict"]
+        ids = list(embedding_dict)
+        matrix = np.asarray([embedding_dict[i] for i in ids], dtype=np.float32)
+    else:
+        import faiss
+        index = faiss.read_index(path)
+        matrix = index.reconstruct_n(0, index.ntotal).astype(np.float32)
+        # FaissVectorStore hands back the faiss row number as the id
+        ids = [str(i) for i in range(index.ntotal)]
+
+    # Persisted faiss indexes can hold rows for other acts, keep only this index's rows
+    nodes = nodes_dict(persist_dir)
+    keep = [i for i, vector_id in enumerate(ids) if vector_id in nodes]
+    return [ids[i] for i in keep], matrix[keep]
+
+
+def convert(persist_dir: str):
+    ids, matrix = read_persisted(persist_dir)
+
+    # Rows are stored unit-length so a dot product is the cosine similarity
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix = np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+    matrix_path = os.path.join(persist_dir, MATRIX_FILE)
+    ids_path = os.path.join(persist_dir, IDS_FILE)
+    with open(matrix_path + ".tmp", "wb") as f:
+        np.save(f, matrix)
+    with open(ids_path + ".tmp", "w") as f:
+        json.dump(ids, f)
+    os.replace(ids_path + ".tmp", ids_path)
+    os.replace(matrix_path + ".tmp", matrix_path)
+    return matrix.shape
+
+
+class MmapVectorStore(BasePydanticVectorStore):
+    stores_text: bool = False
+
+    _matrix: Any = PrivateAttr()
+    _ids: List[str] = PrivateAttr()
+
+    def __init__(self, matrix, ids: List[str]) -> None:
+        super().__init__()
+        self._matrix = matrix
+        self._ids = ids
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str) -> "MmapVectorStore":
+        matrix = np.load(os.path.join(persist_dir, MATRIX_FILE), mmap_mode="r")
+        with open(os.path.join(persist_dir, IDS_FILE)) as f:
+            ids = json.load(f)
+        return cls(matrix, ids)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MmapVectorStore"
+
+    @property
+    def client(self) -> Any:
+        return self._matrix
+
+    @property
+    def matrix(self):
+        return self._matrix
+
+    @property
+    def ids(self) -> List[str]:
+        return self._ids
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        raise ReadOnlyStoreError("MmapVectorStore is read-only, rebuild it with mmap_store.convert")
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        raise ReadOnlyStoreError("MmapVectorStore is read-only, rebuild it with mmap_store.convert")
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.filters is not None:
+            raise ValueError("Metadata filters not implemented for MmapVectorStore")
+
+        indices, scores = top_k(self._matrix, query.query_embedding, query.similarity_top_k)
+
+        return VectorStoreQueryResult(
+            similarities=[float(s) for s in scores[0]],
+            ids=[self._ids[i] for i in indices[0]],
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python mmap_store.py <persist_dir> [<persist_dir> ...]")
+    for persist_dir in sys.argv[1:]:
+        rows, dims = convert(persist.resolve(persist_dir))
+        print(f"{persist_dir}: {rows} x {dims} -> {MATRIX_FILE}")
@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+from pymongo import monitoring
+from pymongo.mongo_client import MongoClient
+from pymongo.server_api import ServerApi
+from dotenv import load_dotenv
+
+import telemetry
+
+load_dotenv()
+
+logger = telemetry.get_logger("mongo")
+
+WAIT_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0]
+
+
+def _options():
+    return {
+        "server_api": ServerApi('1'),
+        "maxPoolSize": int(os.environ.get("MONGO_MAX_POOL_SIZE", 50)),
+        "minPoolSize": int(os.environ.get("MONGO_MIN_POOL_SIZE", 0)),
+        "maxIdleTimeMS": int(os.environ.get("MONGO_MAX_IDLE_MS", 60000)),
+        "waitQueueTimeoutMS": int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000)),
+        "connectTimeoutMS": int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", 5000)),
+        "serverSelectionTimeoutMS": int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 10000)),
+        "readPreference": os.environ.get("MONGO_READ_PREFERENCE", "primaryPreferred"),
+    }
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    def __init__(self) -> None:
+        self.checkouts = 0
+        self.failed = 0
+        self.checked_out = 0
+        self.created = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_buckets = [0] * (len(WAIT_BUCKETS) + 1)
+        self._started = threading.local()
+        self._lock = threading.Lock()
+
+    def _record_wait(self, event):
+        duration = getattr(event, "duration", None)
+        if duration is None:
+            started = getattr(self._started, "at", None)
+            duration = time.perf_counter() - started if started is not None else 0.0
+        with self._lock:
+            self.wait_total += duration
+            self.wait_max = max(self.wait_max, duration)
+            for n, bound in enumerate(WAIT_BUCKETS):
+                if duration <= bound:
+                    self.wait_buckets[n] += 1
+                    break
+            else:
+                self.wait_buckets[-1] += 1
+
+    def connection_check_out_started(self, event):
+        self._started.at = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        self._record_wait(event)
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+
+    def connection_check_out_failed(self, event):
+        self._record_wait(event)
+        with self._lock:
+            self.failed += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.created += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "checkout_failures": self.failed,
+                "checked_out": self.checked_out,
+                "connections_created": self.created,
+                "wait_seconds_total": self.wait_total,
+                "wait_seconds_max": self.wait_max,
+                "wait_seconds_avg": self.wait_total / self.checkouts if self.checkouts else 0.0,
+                "wait_buckets": dict(zip([str(b) for b in WAIT_BUCKETS] + ["+Inf"], self.wait_buckets)),
+            }
+
+
+class CommandTimer(monitoring.CommandListener):
+    def _record(self, event):
+        duration = event.duration_micros / 1e6
+        telemetry.mongo_seconds.observe(duration, command=event.command_name)
+        telemetry.record("mongo", time.perf_counter() - duration, duration, command=event.command_name)
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        telemetry.errors_total.inc(stage="mongo")
+        self._record(event)
+
+
+class MongoManager:
+    def __init__(self, uri: str = None) -> None:
+        self.uri = uri
+        self.pool_stats = PoolStats()
+        self.commands = CommandTimer()
+        self._client = None
+        self._async_client = None
+        self._lock = threading.Lock()
+
+    def _uri(self) -> str:
+        return self.uri or os.environ['MONGO_URI']
+
+    @property
+    def client(self) -> MongoClient:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = MongoClient(self._uri(), connect=False, event_listeners=[self.pool_stats, self.commands], **_options())
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            from motor.motor_asyncio import AsyncIOMotorClient
+            with self._lock:
+                if self._async_client is None:
+                    self._async_client = AsyncIOMotorClient(self._uri(), event_listeners=[self.pool_stats, self.commands], **_options())
+        return self._async_client
+
+    def ping(self) -> bool:
+        try:
+            self.client.admin.command('ping')
+            return True
+        except Exception as e:
+            logger.warning("mongo ping failed: %s", e)
+            return False
+
+    async def aping(self) -> bool:
+        try:
+            await self.async_client.admin.command('ping')
+            return True
+        except Exception as e:
+            logger.warning("mongo ping failed: %s", e)
+            return False
+
+    def stats(self) -> dict:
+        return self.pool_stats.snapshot()
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+            if self._async_client is not None:
+                self._async_client.close()
+                self._async_client = None
+
+
+mongo = MongoManager()
@@ -0,0 +1,56 @@
+import os
+import time
+import shutil
+import tempfile
+
+# Names the version directory readers load, swapped with a single rename so an ingest
+# publishes every file of an index at once
+CURRENT_FILE = "CURRENT"
+VERSION_PREFIX = "v-"
+# Versions kept behind the current one, a worker that resolved one just before the switch can finish loading it
+KEEP_VERSIONS = int(os.environ.get("PERSIST_KEEP_VERSIONS", 1))
+
+
+def current(persist_dir: str):
+    try:
+        with open(os.path.join(persist_dir, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def resolve(persist_dir: str) -> str:
+    # Directory holding the index files, the persist dir itself for indexes written before versioning
+    version = current(persist_dir)
+    return os.path.join(persist_dir, version) if version else persist_dir
+
+
+def new_version(persist_dir: str) -> str:
+    os.makedirs(persist_dir, exist_ok=True)
+    # The timestamp orders versions by name for pruning
+    return tempfile.mkdtemp(prefix=f"{VERSION_PREFIX}{time.time_ns():020d}-", dir=persist_dir)
+
+
+def publish(persist_dir: str, version_dir: str):
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{CURRENT_FILE}.", suffix=".tmp", dir=persist_dir)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(os.path.basename(version_dir))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(persist_dir, CURRENT_FILE))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    _prune(persist_dir)
+
+
+def _prune(persist_dir: str):
+    version = current(persist_dir)
+    older = sorted(
+        name for name in os.listdir(persist_dir)
+        if name.startswith(VERSION_PREFIX) and name < version
+    )
+    for name in older[:max(0, len(older) - KEEP_VERSIONS)]:
+        shutil.rmtree(os.path.join(persist_dir, name), ignore_errors=True)
+    # Files of a flat layout are left alone, readers ignore them while CURRENT exists
@@ -1,4 +1,7 @@
-from database import get_desc
+from database import get_desc, aget_desc
+import telemetry
+
+logger = telemetry.get_logger("prompts")
 
 
 class Prompt:
@@ -29,7 +32,7 @@ class Prompt:
         """
 
     def evalPrompt(kwargs):
-        print(kwargs)
+        logger.debug("evaluating application %s", kwargs)
         prev = ""
 
         previous_case = kwargs.get("previous_case", "").lower().strip()
@@ -39,6 +42,23 @@ class Prompt:
         if previous_case == "yes":
             prev = get_desc(prev_offence_acts, prev_sections_offence)
 
+        return Prompt.evalTemplate(kwargs, prev)
+
+    async def aevalPrompt(kwargs, prev=None):
+        if prev is None:
+            prev = await Prompt.aprevious(kwargs)
+        return Prompt.evalTemplate(kwargs, prev)
+
+    async def aprevious(kwargs):
+        previous_case = kwargs.get("previous_case", "").lower().strip()
+        prev_offence_acts = kwargs.get("prev_offence_acts", "")
+        prev_sections_offence = kwargs.get("prev_sections_offence", "")
+
+        if previous_case == "yes":
+            return await aget_desc(prev_offence_acts, prev_sections_offence)
+        return ""
+
+    def evalTemplate(kwargs, prev):
         return f"""
         Assess the eligibility for bail based on the following user-provided inputs. Follow the reasoning process outlined below to determine whether bail should be granted or denied, and under what conditions.
 
@@ -2,11 +2,12 @@ import os
 import re
 import tempfile
 import time
+from functools import partial
 import openai
 import faiss
 from typing import List, Union
 
-from llama_index.core import StorageContext, Settings, load_index_from_storage
+from llama_index.core import StorageContext, Settings, load_index_from_storage, get_response_synthesizer
 from llama_index.core import SimpleDirectoryReader
 from llama_index.core.tools import QueryEngineTool, ToolMetadata
 from llama_index.core.query_engine import RouterQueryEngine, SubQuestionQueryEngine, CitationQueryEngine
@@ -20,9 +21,14 @@ from langchain_core.prompts import PromptTemplate
 from langchain_core.tools import Tool
 
 import utils
-
-import nest_asyncio
-nest_asyncio.apply()
+from registry import QA_ACTS, registry
+from concurrency import run_blocking
+from streaming import LangChainEvents, stream_query, astream_query
+from tracing import agent_config
+from retrieval import BatchedSubQuestionQueryEngine
+from statutes import statute_lookup
+from act_router import ActRouter, RoutedQueryEngine
+from query_rewrite import QUERY_REWRITE, rewrite as rewrite_query
 
 class RAG:
 
@@ -35,36 +41,44 @@ class RAG:
     descriptions.append("The Insurance Regulatory and Development Authority Act Act, 1999 established the Insurance Regulatory and Development Authority of India (IRDAI) to regulate, promote, and ensure orderly growth of the insurance sector. It empowers IRDAI to license entities, protect policyholders, oversee operations, and amend existing insurance laws, ensuring transparency, accountability, and development within the insurance industry.")
     descriptions.append("The Motor Vehicles Act, 1988 regulates all aspects of road transport in India, including licensing, registration, permits, traffic control, insurance, liability, and penalties. It ensures road safety, sets standards for drivers and vehicles, and establishes legal frameworks for compensation, offences, and enforcement by authorities at both state and central levels.")
     
-    def query_engine(self):
-        query_engine_tools = []
+    def query_engine(self, streaming: bool = False):
+        query_engine_tools = {}
+        acts = {}
+        engines = {}
         temp = ['insurance', 'cpa', 'irda', 'mva']
         for n, x in enumerate(temp):
-            path = os.path.join("./storage/",x)
-            vector_store = FaissVectorStore.from_persist_dir(persist_dir=path)
-            storage_context = StorageContext.from_defaults(
-                vector_store=vector_store,
-                persist_dir=path
-            )
-            index = load_index_from_storage(storage_context=storage_context)
-            engine = index.as_query_engine(similarity_top_k=3)
-            query_engine_tools.append(QueryEngineTool(
+            engine = registry.query_engine(os.path.join("storage", x), similarity_top_k=3)
+            query_engine_tools[RAG.names[n]] = QueryEngineTool(
                 query_engine = engine,
                 metadata = ToolMetadata(name = RAG.names[n], description = RAG.descriptions[n])
-            ))
+            )
+            acts[RAG.names[n]] = os.path.join("storage", x)
+            engines[RAG.names[n]] = registry.query_engine(os.path.join("storage", x), similarity_top_k=3, streaming=True, use_async=True) if streaming else engine
+
         # query_engine = RouterQueryEngine.from_defaults(query_engine_tools = query_engine_tools)
-        query_engine = SubQuestionQueryEngine.from_defaults(query_engine_tools=query_engine_tools, use_async=True)
+        def fan_out(names):
+            return BatchedSubQuestionQueryEngine.from_acts(
+                query_engine_tools=[query_engine_tools[name] for name in names],
+                acts={name: acts[name] for name in names},
+                multi_act=registry.multi_act([acts[name] for name in names]),
+                similarity_top_k=3,
+                response_synthesizer=get_response_synthesizer(streaming=True, use_async=True) if streaming else None,
+                use_async=True
+            )
 
-        return query_engine
+        # Questions about a single act skip the sub-question generation call
+        return RoutedQueryEngine(act_router, engines, fan_out)
     
     @staticmethod
-    def processing_agent(query:str):
+    def agent_executor(streaming: bool = False):
 
         rag_instance = RAG()
-        query_engine = rag_instance.query_engine()
+        query_engine = rag_instance.query_engine(streaming=streaming)
     
         tools = [Tool(
             name="Llama-Index",
-            func=query_engine.query,
+            func=partial(stream_query, query_engine) if streaming else query_engine.query,
+            coroutine=partial(astream_query, query_engine) if streaming else query_engine.aquery,
             description=f"Useful for when you want to answer questions. The input to this tool should be a complete English sentence. Works best if you redirect the entire query back into this. This is an AI Assistant, ask complete questions, articulate well.",
             return_direct=True
             )
@@ -110,9 +124,62 @@ class RAG:
             prompt=prompt,
         )
 
-        agent_executor = AgentExecutor.from_agent_and_tools(agent=agent, tools=tools, verbose=True, return_intermediate_steps=True)
+        return AgentExecutor.from_agent_and_tools(agent=agent, tools=tools, return_intermediate_steps=True)
+
+    @staticmethod
+    def processing_agent(query:str):
+        response = statute_lookup.answer(query)
+        if response is not None:
+            return {"input": query, "output": response}
+        return RAG.agent_executor().invoke({"input":query}, config=agent_config())
 
-        return agent_executor.invoke({"input":query})
+    @staticmethod
+    async def aprocessing_agent(query:str):
+        response = await statute_lookup.aanswer(query)
+        if response is not None:
+            return {"input": query, "output": response}
+        agent_executor = await run_blocking(RAG.agent_executor)
+        return await agent_executor.ainvoke({"input":query}, config=agent_config())
+
+    @staticmethod
+    async def astream_agent(query:str):
+        response = await statute_lookup.aanswer(query)
+        if response is not None:
+            return {"input": query, "output": response}
+        agent_executor = await run_blocking(RAG.agent_executor, streaming=True)
+        return await agent_executor.ainvoke({"input":query}, config=agent_config(LangChainEvents()))
+
+    # Direct mode skips the ReAct agent, its only step was handing the query to the tool
+    @staticmethod
+    def direct(query:str, rewrite:bool = QUERY_REWRITE):
+        question = rewrite_query(query, QA_ACTS) if rewrite else query
+        response = statute_lookup.answer(question)
+        if response is None:
+            response = RAG().query_engine().query(question)
+        return {"input": query, "output": response}
+
+    @staticmethod
+    async def adirect(query:str, rewrite:bool = QUERY_REWRITE):
+        question = rewrite_query(query, QA_ACTS) if rewrite else query
+        response = await statute_lookup.aanswer(question)
+        if response is None:
+            query_engine = await run_blocking(RAG().query_engine)
+            response = await query_engine.aquery(question)
+        return {"input": query, "output": response}
+
+    @staticmethod
+    async def astream_direct(query:str, rewrite:bool = QUERY_REWRITE):
+        question = rewrite_query(query, QA_ACTS) if rewrite else query
+        response = await statute_lookup.aanswer(question)
+        if response is None:
+            query_engine = await run_blocking(RAG().query_engine, streaming=True)
+            response = await astream_query(query_engine, question)
+        return {"input": query, "output": response}
+
+act_router = ActRouter(
+    {name: os.path.join("storage", x) for name, x in zip(RAG.names, ['insurance', 'cpa', 'irda', 'mva'])},
+    dict(zip(RAG.names, RAG.descriptions)),
+)
 
 # inst = RAG.processing_agent(query="I got accident with my car, and a dog was killed in that incident, so what could be the legal consequences?")
 
@@ -0,0 +1,146 @@
+import os
+import json
+import argparse
+import numpy as np
+
+import faiss
+
+import persist
+from mmap_store import IDS_FILE, MATRIX_FILE, convert, has_mmap_store
+from retrieval import ActMatrix, normalize, select_top_k
+
+# exact keeps the float32 matrix, sq8 and ivfpq search compressed codes and re-rank the candidates exactly
+VECTOR_INDEX = os.environ.get("VECTOR_INDEX", "exact")
+MODES = ("sq8", "ivfpq")
+# Candidates pulled from the compressed index per result, 0 returns the approximate scores as they are
+RERANK_FACTOR = int(os.environ.get("RERANK_FACTOR", 4))
+IVF_NPROBE = int(os.environ.get("IVF_NPROBE", 8))
+PQ_SUBQUANTIZERS = int(os.environ.get("PQ_SUBQUANTIZERS", 96))
+
+
+def quantized_file(mode: str) -> str:
+    return f"default__vector_store.{mode}.faiss"
+
+
+def has_quantized(persist_dir: str, mode: str) -> bool:
+    return mode in MODES and has_mmap_store(persist_dir) and os.path.exists(os.path.join(persist_dir, quantized_file(mode)))
+
+
+def load_matrix(persist_dir: str):
+    matrix = np.load(os.path.join(persist_dir, MATRIX_FILE), mmap_mode="r")
+    with open(os.path.join(persist_dir, IDS_FILE)) as f:
+        ids = json.load(f)
+    return ids, matrix
+
+
+def build_index(matrix, mode: str):
+    rows, dims = matrix.shape
+    if mode == "sq8":
+        index = faiss.IndexScalarQuantizer(dims, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    elif mode == "ivfpq":
+        # k-means needs at least as many rows as centroids, small acts get coarser lists and codebooks
+        nlist = max(1, int(np.sqrt(rows)))
+        nbits = max(1, min(8, int(np.log2(rows))))
+        m = PQ_SUBQUANTIZERS if dims % PQ_SUBQUANTIZERS == 0 else 1
+        index = faiss.IndexIVFPQ(faiss.IndexFlatIP(dims), dims, nlist, m, nbits, faiss.METRIC_INNER_PRODUCT)
+    else:
+        raise ValueError(f"unknown vector index mode {mode!r}, expected one of {MODES}")
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    index.train(matrix)
+    index.add(matrix)
+    return index
+
+
+def quantize(persist_dir: str, mode: str):
+    if not has_mmap_store(persist_dir):
+        # The compressed codes index rows of the mmap store, which also serves the exact re-rank
+        convert(persist_dir)
+    _, matrix = load_matrix(persist_dir)
+    index = build_index(matrix, mode)
+
+    path = os.path.join(persist_dir, quantized_file(mode))
+    faiss.write_index(index, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return index
+
+
+def read_index(persist_dir: str, mode: str):
+    index = faiss.read_index(os.path.join(persist_dir, quantized_file(mode)))
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = min(IVF_NPROBE, index.nlist)
+    return index
+
+
+class QuantizedActMatrix(ActMatrix):
+    def __init__(self, ids, matrix, index, lexical=None, rerank: int = RERANK_FACTOR) -> None:
+        # matrix is the memory-mapped float32 store, only the re-ranked candidate rows are read from it
+        self.ids = list(ids)
+        self.matrix = matrix
+        self.index = index
+        self.lexical = lexical
+        self.rerank = rerank
+
+    @classmethod
+    def load(cls, persist_dir: str, mode: str, lexical=None) -> "QuantizedActMatrix":
+        ids, matrix = load_matrix(persist_dir)
+        return cls(ids, matrix, read_index(persist_dir, mode), lexical=lexical)
+
+    def search(self, queries, k: int):
+        queries = normalize(queries)
+        k = min(k, len(self.ids))
+        candidates = min(len(self.ids), k * self.rerank) if self.rerank else k
+        approx_scores, rows = self.index.search(queries, max(candidates, k))
+        indices, scores = [], []
+        for query, row, row_scores in zip(queries, rows, approx_scores):
+            # IVF pads with -1 when the probed lists hold fewer rows than asked for
+            found = row >= 0
+            row, row_scores = row[found], row_scores[found]
+            if self.rerank:
+                row = np.sort(row)
+                row_scores = np.asarray(self.matrix[row]) @ query
+                order = np.argsort(-row_scores, kind="stable")[:k]
+                row, row_scores = row[order], row_scores[order]
+            indices.append(row[:k])
+            scores.append(row_scores[:k])
+        return indices, scores
+
+
+def recall(exact, approx) -> float:
+    hits = sum(len(set(e) & set(a)) for e, a in zip(exact, approx))
+    return hits / max(1, sum(len(e) for e in exact))
+
+
+def report(persist_dir: str, modes, k: int):
+    ids, matrix = load_matrix(persist_dir)
+    queries = np.ascontiguousarray(matrix, dtype=np.float32)
+    exact, _ = select_top_k(queries @ queries.T, k)
+    lines = [f"{persist_dir}: {len(ids)} x {matrix.shape[1]}, exact {matrix.nbytes / 1e6:.2f} MB"]
+    for mode in modes:
+        index = read_index(persist_dir, mode)
+        size = len(faiss.serialize_index(index))
+        approx = QuantizedActMatrix(ids, matrix, index, rerank=0).search(queries, k)[0]
+        reranked = QuantizedActMatrix(ids, matrix, index).search(queries, k)[0]
+        lines.append(
+            f"  {mode}: {size / 1e6:.2f} MB ({size / matrix.nbytes:.1%}), "
+            f"recall@{k} {recall(exact, approx):.3f}, re-ranked {recall(exact, reranked):.3f}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build compressed vector indexes next to the mmap store")
+    parser.add_argument("persist_dirs", nargs="+")
+    parser.add_argument("--mode", choices=MODES + ("all",), default="all")
+    parser.add_argument("--report", action="store_true", help="print memory and recall against the exact search")
+    parser.add_argument("-k", type=int, default=5)
+    args = parser.parse_args()
+
+    modes = MODES if args.mode == "all" else (args.mode,)
+    for persist_dir in args.persist_dirs:
+        # The codes go next to the version the CURRENT pointer names
+        persist_dir = persist.resolve(persist_dir)
+        for mode in modes:
+            index = quantize(persist_dir, mode)
+            print(f"{persist_dir}: {index.ntotal} rows -> {quantized_file(mode)}")
+        if args.report:
+            print(report(persist_dir, modes, args.k))
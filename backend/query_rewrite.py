@@ -0,0 +1,53 @@
+import os
+import re
+
+QUERY_REWRITE = os.environ.get("QUERY_REWRITE", "1") != "0"
+
+# Chat filler the agent used to drop before calling its tool
+FILLER = re.compile(
+    r"^\s*(?:(?:hi|hello|hey|dear sir|sir|madam)\b[\s,!.]*)*"
+    r"(?:(?:please|kindly)\s+)?"
+    r"(?:(?:can|could|would|will)\s+you\s+(?:please\s+)?(?:tell|explain|let)\s+(?:me\s+)?(?:know\s+)?(?:about\s+)?|i\s+want\s+to\s+know\s+(?:about\s+)?|tell\s+me\s+(?:about\s+)?)?",
+    re.IGNORECASE,
+)
+TRAILING = re.compile(r"[\s,]*(?:please|thanks|thank\s+you)[\s.!]*$", re.IGNORECASE)
+
+ABBREVIATIONS = {
+    r"\bu/s\b": "under section",
+    r"\bsec\.?(?=\s*\d)": "section",
+    r"\bpls\b|\bplz\b": "please",
+    r"\bw/o\b": "without",
+    r"\bdl\b": "driving licence",
+}
+# Act acronyms expand only in a pipeline serving that act, TPA is a Third Party Administrator
+# to an insurance question and ICA or SRA mean other things outside the civil acts
+ACT_ABBREVIATIONS = {
+    "mva": {r"\bM\.?\s?V\.?\s?Act\b|\bMVA\b": "Motor Vehicles Act"},
+    "cpa": {r"\bCPA\b": "Consumer Protection Act"},
+    "irda": {r"\bIRDAI?\b": "Insurance Regulatory and Development Authority"},
+    "ica": {r"\bICA\b": "Indian Contract Act"},
+    "sra": {r"\bSRA\b": "Specific Relief Act"},
+    "tpa": {r"\bTPA\b": "Transfer of Property Act"},
+    "rti": {r"\bRTI\b": "Right to Information"},
+}
+
+
+def _compile(abbreviations):
+    return [(re.compile(pattern, re.IGNORECASE), replacement) for pattern, replacement in abbreviations.items()]
+
+
+_abbreviations = _compile(ABBREVIATIONS)
+_act_abbreviations = {act: _compile(abbreviations) for act, abbreviations in ACT_ABBREVIATIONS.items()}
+
+
+def rewrite(query: str, acts=()) -> str:
+    # Local stand-in for the agent's rephrasing step, no model call. acts are the registry
+    # names the calling pipeline answers from, e.g. registry.QA_ACTS
+    text = re.sub(r"\s+", " ", query).strip()
+    patterns = _abbreviations + [pattern for act in acts for pattern in _act_abbreviations.get(act, [])]
+    for pattern, replacement in patterns:
+        text = pattern.sub(replacement, text)
+    text = TRAILING.sub("", FILLER.sub("", text, count=1)).strip()
+    if not text:
+        return query.strip()
+    return text[0].upper() + text[1:]
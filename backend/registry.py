@@ -0,0 +1,189 @@
+import os
+import threading
+import time
+
+from llama_index.core import StorageContext, load_index_from_storage
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.vector_stores.faiss import FaissVectorStore
+
+import utils
+import lexical
+import persist
+import telemetry
+from mmap_store import MmapVectorStore, has_mmap_store
+from quantize import VECTOR_INDEX, QuantizedActMatrix, has_quantized
+from retrieval import DEFAULT_TOP_K, ActMatrix, MatrixRetriever, MultiActMatrix
+
+RELOAD_CHECK_INTERVAL = float(os.environ.get("INDEX_RELOAD_INTERVAL", 30))
+
+QA_ACTS = ['insurance', 'cpa', 'irda', 'mva']
+DOC_ACTS = ['ica', 'sra', 'tpa', 'upra', 'rti']
+
+
+class _Entry:
+    def __init__(self, persist_dir: str, faiss: bool, index_id: str = None) -> None:
+        self.persist_dir = persist_dir
+        # Version directory the loaded index was read from
+        self.data_dir = None
+        self.faiss = faiss
+        self.index_id = index_id
+        self.lock = threading.RLock()
+        self.index = None
+        self.engines = {}
+        self.matrix = None
+        self.lexical = None
+        self.quantized = False
+        self.signature = None
+        self.checked_at = 0.0
+        self.version = 0
+
+
+class IndexRegistry:
+    def __init__(self, check_interval: float = RELOAD_CHECK_INTERVAL) -> None:
+        self.check_interval = check_interval
+        self._entries = {}
+        self._listeners = []
+        self._multi_acts = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, persist_dir: str, faiss: bool = False, index_id: str = None):
+        with self._lock:
+            self._entries[name] = _Entry(persist_dir, faiss, index_id)
+
+    def names(self):
+        return list(self._entries)
+
+    def on_reload(self, callback):
+        self._listeners.append(callback)
+
+    def version(self, name: str) -> int:
+        return self._entries[name].version
+
+    def _signature(self, data_dir: str):
+        # Names the version a CURRENT pointer switched to, files still count for in-place conversions
+        signature = [data_dir]
+        for file_name in sorted(os.listdir(data_dir)):
+            if file_name == lexical.LEXICAL_FILE or file_name.endswith(".tmp"):
+                # Derived from docstore.json and rewritten on load, or still being written
+                continue
+            stat = os.stat(os.path.join(data_dir, file_name))
+            signature.append((file_name, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def _load(self, entry: _Entry):
+        start = time.perf_counter()
+        data_dir = persist.resolve(entry.persist_dir)
+        signature = self._signature(data_dir)
+        if has_mmap_store(data_dir):
+            vector_store = MmapVectorStore.from_persist_dir(data_dir)
+            storage_context = StorageContext.from_defaults(
+                vector_store=vector_store,
+                persist_dir=data_dir
+            )
+        elif entry.faiss:
+            vector_store = FaissVectorStore.from_persist_dir(persist_dir=data_dir)
+            storage_context = StorageContext.from_defaults(
+                vector_store=vector_store,
+                persist_dir=data_dir
+            )
+        else:
+            storage_context = StorageContext.from_defaults(persist_dir=data_dir)
+        index = load_index_from_storage(storage_context=storage_context, index_id=entry.index_id)
+
+        entry.index = index
+        entry.quantized = has_quantized(data_dir, VECTOR_INDEX)
+        entry.lexical = lexical.load(data_dir, index.index_struct.nodes_dict)
+        entry.engines = {}
+        entry.matrix = None
+        entry.data_dir = data_dir
+        entry.signature = signature
+        entry.checked_at = time.monotonic()
+        entry.version += 1
+        telemetry.record("index_load", start, time.perf_counter() - start, index=entry.persist_dir)
+
+    def _stale(self, entry: _Entry) -> bool:
+        if self.check_interval < 0:
+            return False
+        now = time.monotonic()
+        if now - entry.checked_at < self.check_interval:
+            return False
+        entry.checked_at = now
+        return self._signature(persist.resolve(entry.persist_dir)) != entry.signature
+
+    def index(self, name: str):
+        entry = self._entries[name]
+        reloaded = False
+        with entry.lock:
+            if entry.index is None:
+                self._load(entry)
+            elif self._stale(entry):
+                self._load(entry)
+                reloaded = True
+            index = entry.index
+        if reloaded:
+            for callback in self._listeners:
+                callback(name)
+        return index
+
+    def _matrix(self, entry: _Entry, index, lexical=None) -> ActMatrix:
+        if entry.quantized:
+            return QuantizedActMatrix.load(entry.data_dir, VECTOR_INDEX, lexical=lexical)
+        return ActMatrix.from_index(index, lexical=lexical)
+
+    def _snapshot(self, name: str):
+        index = self.index(name)
+        entry = self._entries[name]
+        with entry.lock:
+            if entry.index is not index:
+                return index, ActMatrix.from_index(index), False
+            if entry.matrix is None:
+                entry.matrix = self._matrix(entry, index, lexical=entry.lexical)
+            return index, entry.matrix, True
+
+    def matrix(self, name: str) -> ActMatrix:
+        return self._snapshot(name)[1]
+
+    def multi_act(self, names: list) -> MultiActMatrix:
+        acts = {name: self.matrix(name) for name in names}
+        key = tuple(names)
+        with self._lock:
+            cached = self._multi_acts.get(key)
+            if cached is None or any(cached.acts[name] is not acts[name] for name in names):
+                cached = MultiActMatrix(acts)
+                self._multi_acts[key] = cached
+        return cached
+
+    def query_engine(self, name: str, **kwargs):
+        index, matrix, current = self._snapshot(name)
+        entry = self._entries[name]
+        key = tuple(sorted(kwargs.items()))
+        with entry.lock:
+            current = current and entry.matrix is matrix
+            engine = entry.engines.get(key) if current else None
+            if engine is None:
+                similarity_top_k = kwargs.pop("similarity_top_k", DEFAULT_TOP_K)
+                retriever = MatrixRetriever(index, matrix, similarity_top_k=similarity_top_k)
+                engine = RetrieverQueryEngine.from_args(retriever, **kwargs)
+                if current:
+                    entry.engines[key] = engine
+        return engine
+
+    def reload(self, name: str):
+        entry = self._entries[name]
+        with entry.lock:
+            self._load(entry)
+        for callback in self._listeners:
+            callback(name)
+
+    def preload(self, names: list = None):
+        for name in names or self.names():
+            self.index(name)
+
+
+registry = IndexRegistry()
+
+for x in QA_ACTS:
+    registry.register(os.path.join("storage", x), os.path.join("./storage/", x), faiss=True)
+
+for x in DOC_ACTS:
+    registry.register(x, x, index_id="vector_index")
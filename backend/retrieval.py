@@ -0,0 +1,277 @@
+import os
+import asyncio
+import numpy as np
+from typing import Any, Dict, List, Optional
+
+from llama_index.core import Settings
+from llama_index.core.async_utils import run_async_tasks
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.callbacks.schema import CBEventType, EventPayload
+from llama_index.core.query_engine import SubQuestionQueryEngine
+from llama_index.core.query_engine.sub_question_query_engine import SubQuestionAnswerPair
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.vector_stores.faiss import FaissVectorStore
+
+import telemetry
+from lexical import fuse, is_lexical
+
+DEFAULT_TOP_K = 2
+HYBRID_CANDIDATES = int(os.environ.get("HYBRID_CANDIDATES", 20))
+
+logger = telemetry.get_logger("retrieval")
+
+
+def normalize(matrix):
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float32))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def select_top_k(scores, k: int):
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(np.int64), empty.astype(np.float32)
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1)
+    return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(candidate_scores, order, axis=1)
+
+
+def top_k(matrix, queries, k: int):
+    scores = normalize(queries) @ matrix.T
+    return select_top_k(scores, k)
+
+
+class ActMatrix:
+    def __init__(self, ids: List[str], matrix, normalized: bool = False, lexical=None) -> None:
+        self.ids = list(ids)
+        self.matrix = matrix if normalized else normalize(matrix)
+        self.lexical = lexical
+
+    @classmethod
+    def from_index(cls, index, lexical=None) -> "ActMatrix":
+        vector_store = index.vector_store
+        normalized = False
+        if hasattr(vector_store, "matrix") and hasattr(vector_store, "ids"):
+            # MmapVectorStore rows are already unit length
+            ids, matrix, normalized = vector_store.ids, vector_store.matrix, True
+        elif isinstance(vector_store, FaissVectorStore):
+            faiss_index = vector_store.client
+            ids = [str(i) for i in range(faiss_index.ntotal)]
+            matrix = faiss_index.reconstruct_n(0, faiss_index.ntotal)
+        else:
+            embedding_dict = vector_store.to_dict()["embedding_dict"]
+            ids = list(embedding_dict)
+            matrix = [embedding_dict[i] for i in ids]
+
+        nodes_dict = index.index_struct.nodes_dict
+        keep = [i for i, vector_id in enumerate(ids) if vector_id in nodes_dict]
+        if len(keep) < len(ids):
+            ids = [ids[i] for i in keep]
+            matrix = np.asarray(matrix)[keep]
+        return cls(ids, matrix, normalized=normalized, lexical=lexical)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, queries, k: int):
+        return top_k(self.matrix, queries, k)
+
+    def lexical_hits(self, query: str, k: int):
+        # Identifier-heavy queries like "section 185" are answered by BM25 alone, without an embedding call
+        if self.lexical is None or not is_lexical(query):
+            return None
+        return self.lexical.search(query, k) or None
+
+    def hybrid_hits(self, query: str, vector_hits, k: int):
+        if self.lexical is None:
+            return vector_hits[:k]
+        return fuse([vector_hits, self.lexical.search(query, max(k, HYBRID_CANDIDATES))], k)
+
+
+class MultiActMatrix:
+    def __init__(self, acts: Dict[str, ActMatrix]) -> None:
+        # Every act keeps its own, possibly memory-mapped, matrix. Stacking them would copy
+        # all of them into private memory in each worker.
+        self.acts = acts
+
+    def _hits(self, name: str, queries, k: int):
+        act = self.acts[name]
+        indices, scores = act.search(queries, k)
+        return [
+            [(act.ids[i], float(s)) for i, s in zip(row, row_scores)]
+            for row, row_scores in zip(indices, scores)
+        ]
+
+    def search(self, queries, k: int, names: Optional[List[str]] = None):
+        queries = normalize(queries)
+        return {name: self._hits(name, queries, k) for name in names or self.acts}
+
+    def search_each(self, queries, names: List[str], k: int):
+        # queries[i] is only scored against the act names[i], questions for the same act share one product
+        queries = normalize(queries)
+        rows = {}
+        for i, name in enumerate(names):
+            rows.setdefault(name, []).append(i)
+        results = [None] * len(names)
+        for name, act_rows in rows.items():
+            for i, hits in zip(act_rows, self._hits(name, queries[act_rows], k)):
+                results[i] = hits
+        return results
+
+
+class MatrixRetriever(BaseRetriever):
+    def __init__(self, index, matrix: ActMatrix, similarity_top_k: int = DEFAULT_TOP_K, **kwargs: Any) -> None:
+        self._index = index
+        self._matrix = matrix
+        self._embed_model = index._embed_model
+        self.similarity_top_k = similarity_top_k
+        super().__init__(callback_manager=index._callback_manager, **kwargs)
+
+    def nodes_from_hits(self, hits) -> List[NodeWithScore]:
+        nodes_dict = self._index.index_struct.nodes_dict
+        nodes = self._index.docstore.get_nodes([nodes_dict[vector_id] for vector_id, _ in hits])
+        return [NodeWithScore(node=node, score=score) for node, (_, score) in zip(nodes, hits)]
+
+    def _vector_nodes(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        indices, scores = self._matrix.search(query_bundle.embedding, max(self.similarity_top_k, HYBRID_CANDIDATES))
+        hits = [(self._matrix.ids[i], float(s)) for i, s in zip(indices[0], scores[0])]
+        return self.nodes_from_hits(self._matrix.hybrid_hits(query_bundle.query_str, hits, self.similarity_top_k))
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        hits = self._matrix.lexical_hits(query_bundle.query_str, self.similarity_top_k)
+        if hits is not None:
+            return self.nodes_from_hits(hits)
+
+        if query_bundle.embedding is None:
+            query_bundle.embedding = self._embed_model.get_agg_embedding_from_queries(query_bundle.embedding_strs)
+        return self._vector_nodes(query_bundle)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        hits = self._matrix.lexical_hits(query_bundle.query_str, self.similarity_top_k)
+        if hits is not None:
+            return self.nodes_from_hits(hits)
+
+        if query_bundle.embedding is None:
+            query_bundle.embedding = await self._embed_model.aget_agg_embedding_from_queries(query_bundle.embedding_strs)
+        return self._vector_nodes(query_bundle)
+
+
+class BatchedSubQuestionQueryEngine(SubQuestionQueryEngine):
+    _acts: Dict[str, str] = {}
+    _multi_act = None
+    _similarity_top_k = DEFAULT_TOP_K
+
+    @classmethod
+    def from_acts(cls, query_engine_tools, acts: Dict[str, str], multi_act: MultiActMatrix, similarity_top_k: int = DEFAULT_TOP_K, **kwargs: Any):
+        engine = cls.from_defaults(query_engine_tools=query_engine_tools, **kwargs)
+        engine._acts = acts
+        engine._multi_act = multi_act
+        engine._similarity_top_k = similarity_top_k
+        return engine
+
+    def _split(self, sub_questions):
+        sub_questions = [q for q in sub_questions if q.tool_name in self._query_engines]
+        hits = [self._multi_act.acts[self._acts[q.tool_name]].lexical_hits(q.sub_question, self._similarity_top_k) for q in sub_questions]
+        return sub_questions, hits, [q for q, question_hits in zip(sub_questions, hits) if question_hits is None]
+
+    def _nodes(self, sub_questions, hits, embedded, embeddings):
+        if embedded:
+            vector_hits = iter(self._multi_act.search_each(
+                embeddings,
+                [self._acts[q.tool_name] for q in embedded],
+                k=max(self._similarity_top_k, HYBRID_CANDIDATES),
+            ))
+            hits = [
+                question_hits if question_hits is not None else
+                self._multi_act.acts[self._acts[q.tool_name]].hybrid_hits(q.sub_question, next(vector_hits), self._similarity_top_k)
+                for q, question_hits in zip(sub_questions, hits)
+            ]
+        prefetched = []
+        for sub_q, question_hits in zip(sub_questions, hits):
+            with self.callback_manager.event(
+                CBEventType.RETRIEVE, payload={EventPayload.QUERY_STR: sub_q.sub_question}
+            ) as retrieve_event:
+                retriever = self._query_engines[sub_q.tool_name].retriever
+                nodes = retriever.nodes_from_hits(question_hits)
+                retrieve_event.on_end(payload={EventPayload.NODES: nodes})
+            prefetched.append((sub_q, nodes))
+        return prefetched
+
+    def _prefetch(self, sub_questions):
+        sub_questions, hits, embedded = self._split(sub_questions)
+        embeddings = Settings.embed_model.get_text_embedding_batch([q.sub_question for q in embedded]) if embedded else []
+        return self._nodes(sub_questions, hits, embedded, embeddings)
+
+    async def _aprefetch(self, sub_questions):
+        sub_questions, hits, embedded = self._split(sub_questions)
+        embeddings = await Settings.embed_model.aget_text_embedding_batch([q.sub_question for q in embedded]) if embedded else []
+        return self._nodes(sub_questions, hits, embedded, embeddings)
+
+    def _answer(self, sub_q, nodes):
+        with self.callback_manager.event(
+            CBEventType.SUB_QUESTION, payload={EventPayload.SUB_QUESTION: SubQuestionAnswerPair(sub_q=sub_q)}
+        ) as event:
+            engine = self._query_engines[sub_q.tool_name]
+            logger.debug("[%s] Q: %s", sub_q.tool_name, sub_q.sub_question)
+            response = engine.synthesize(QueryBundle(sub_q.sub_question), nodes)
+            qa_pair = SubQuestionAnswerPair(sub_q=sub_q, answer=str(response), sources=response.source_nodes)
+            event.on_end(payload={EventPayload.SUB_QUESTION: qa_pair})
+        return qa_pair
+
+    async def _aanswer(self, sub_q, nodes):
+        with self.callback_manager.event(
+            CBEventType.SUB_QUESTION, payload={EventPayload.SUB_QUESTION: SubQuestionAnswerPair(sub_q=sub_q)}
+        ) as event:
+            engine = self._query_engines[sub_q.tool_name]
+            logger.debug("[%s] Q: %s", sub_q.tool_name, sub_q.sub_question)
+            response = await engine.asynthesize(QueryBundle(sub_q.sub_question), nodes)
+            qa_pair = SubQuestionAnswerPair(sub_q=sub_q, answer=str(response), sources=response.source_nodes)
+            event.on_end(payload={EventPayload.SUB_QUESTION: qa_pair})
+        return qa_pair
+
+    def _query(self, query_bundle: QueryBundle):
+        with self.callback_manager.event(
+            CBEventType.QUERY, payload={EventPayload.QUERY_STR: query_bundle.query_str}
+        ) as query_event:
+            sub_questions = self._question_gen.generate(self._metadatas, query_bundle)
+            prefetched = self._prefetch(sub_questions)
+
+            if self._use_async:
+                qa_pairs = run_async_tasks([self._aanswer(sub_q, nodes) for sub_q, nodes in prefetched])
+            else:
+                qa_pairs = [self._answer(sub_q, nodes) for sub_q, nodes in prefetched]
+
+            nodes = [self._construct_node(pair) for pair in qa_pairs]
+            source_nodes = [node for qa_pair in qa_pairs for node in qa_pair.sources]
+            response = self._response_synthesizer.synthesize(
+                query=query_bundle,
+                nodes=nodes,
+                additional_source_nodes=source_nodes,
+            )
+            query_event.on_end(payload={EventPayload.RESPONSE: response})
+        return response
+
+    async def _aquery(self, query_bundle: QueryBundle):
+        with self.callback_manager.event(
+            CBEventType.QUERY, payload={EventPayload.QUERY_STR: query_bundle.query_str}
+        ) as query_event:
+            sub_questions = await self._question_gen.agenerate(self._metadatas, query_bundle)
+            prefetched = await self._aprefetch(sub_questions)
+
+            qa_pairs = await asyncio.gather(*[self._aanswer(sub_q, nodes) for sub_q, nodes in prefetched])
+
+            nodes = [self._construct_node(pair) for pair in qa_pairs]
+            source_nodes = [node for qa_pair in qa_pairs for node in qa_pair.sources]
+            response = await self._response_synthesizer.asynthesize(
+                query=query_bundle,
+                nodes=nodes,
+                additional_source_nodes=source_nodes,
+            )
+            query_event.on_end(payload={EventPayload.RESPONSE: response})
+        return response
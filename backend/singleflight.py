@@ -0,0 +1,80 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+import telemetry
+
+calls_total = telemetry.metrics.counter("singleflight_calls_total", "Calls through a single-flight group by whether they ran the work or joined it", ["flight", "role"])
+
+_flights = []
+
+
+class SingleFlight:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.leaders = 0
+        self.followers = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+        _flights.append(self)
+
+    def _count(self, leader: bool):
+        if leader:
+            self.leaders += 1
+        else:
+            self.followers += 1
+        calls_total.inc(flight=self.name, role="leader" if leader else "follower")
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def ratio(self) -> float:
+        calls = self.leaders + self.followers
+        return self.followers / calls if calls else 0.0
+
+    async def do(self, key, compute):
+        # compute is a coroutine function, concurrent callers with the same key await one run of it
+        loop = asyncio.get_running_loop()
+        # Tasks belong to their event loop, LlamaIndex runs some async code on loops of its own
+        key = (id(loop), key)
+        with self._lock:
+            task = self._calls.get(key)
+            leader = task is None
+            if leader:
+                task = loop.create_task(compute())
+                self._calls[key] = task
+                task.add_done_callback(lambda done: self._forget(key, done))
+        self._count(leader)
+        # A caller that disconnects must not cancel the result the others are waiting for
+        return await asyncio.shield(task)
+
+    def do_blocking(self, key, func):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+        self._count(leader)
+        if not leader:
+            return future.result()
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._forget(key, future)
+
+
+telemetry.metrics.gauge(
+    "singleflight_coalesced_ratio",
+    "Share of calls that joined a computation already in flight",
+    lambda: {flight.name: flight.ratio() for flight in _flights},
+    ["flight"],
+)
@@ -0,0 +1,169 @@
+import os
+import re
+import threading
+
+from llama_index.core import Settings
+from llama_index.core.base.response.schema import Response
+from llama_index.core.schema import NodeWithScore, TextNode
+
+import citations
+import streaming
+from concurrency import run_blocking
+from database import section_index
+from lexical import STOPWORDS, tokenize
+from registry import registry
+from templates import statute_template
+
+STATUTE_MAX_EXTRA_WORDS = int(os.environ.get("STATUTE_MAX_EXTRA_WORDS", 8))
+STATUTE_SUMMARY = os.environ.get("STATUTE_SUMMARY", "1") != "0"
+SECTION_MAX_CHARS = int(os.environ.get("STATUTE_SECTION_MAX_CHARS", 4000))
+
+# citations act code -> registry index of the act
+ACT_INDEXES = {
+    "Insurance": os.path.join("storage", "insurance"),
+    "CPA": os.path.join("storage", "cpa"),
+    "IRDA": os.path.join("storage", "irda"),
+    "MVA": os.path.join("storage", "mva"),
+}
+ACT_NAMES = {
+    "Insurance": "The Insurance Act, 1938",
+    "CPA": "The Consumer Protection Act",
+    "IRDA": "The Insurance Regulatory and Development Authority Act, 1999",
+    "MVA": "The Motor Vehicles Act, 1988",
+    "IPC": "The Indian Penal Code",
+    "CrPC": "The Code of Criminal Procedure",
+    "BNS": "The Bharatiya Nyaya Sanhita",
+    "BNSS": "The Bharatiya Nagarik Suraksha Sanhita",
+}
+# Acts whose sections live in the Indian_Acts collections
+MONGO_ACTS = ["IPC", "CrPC", "BNS", "BNSS"]
+
+# "185. Driving by a drunken person .—Whoever ...", the table of contents has no dash and is skipped
+HEADING = re.compile(r"^[ \t]*(\d{1,3}[A-Z]{0,3})\.[ \t]*([^\n—–]{2,200}?)[ \t]*\.?[ \t]*[—–]", re.M)
+
+
+class SectionMap:
+    def __init__(self, nodes) -> None:
+        self.sections = {}
+        for i, node in enumerate(nodes):
+            text = node.get_content()
+            headings = list(HEADING.finditer(text))
+            for n, match in enumerate(headings):
+                section = match.group(1).upper()
+                if section in self.sections:
+                    # Later matches are amendments of other acts or schedules
+                    continue
+                if n + 1 < len(headings):
+                    body, used = text[match.start():headings[n + 1].start()], [node]
+                else:
+                    body, used = self._continue(nodes, i, text[match.start():])
+                self.sections[section] = (body.strip()[:SECTION_MAX_CHARS], used)
+
+    def _continue(self, nodes, i, body):
+        # The section runs on into the following chunks until the next heading
+        used = [nodes[i]]
+        for node in nodes[i + 1:i + 3]:
+            text = node.get_content()
+            # Chunks of one page overlap, skip what the previous chunk already had
+            tail = body[-80:]
+            start = text.find(tail)
+            start = start + len(tail) if start >= 0 else 0
+            match = HEADING.search(text, start)
+            end = match.start() if match else len(text)
+            if end > start:
+                body += text[start:end]
+                used.append(node)
+            if match or len(body) >= SECTION_MAX_CHARS:
+                break
+        return body, used
+
+    def get(self, section: str):
+        return self.sections.get(section.upper())
+
+
+class StatuteLookup:
+    def __init__(self) -> None:
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def section_map(self, code: str) -> SectionMap:
+        name = ACT_INDEXES[code]
+        index = registry.index(name)
+        with self._lock:
+            cached = self._maps.get(name)
+            if cached is None or cached[0] is not index:
+                nodes = index.docstore.get_nodes(list(index.index_struct.nodes_dict.values()))
+                cached = (index, SectionMap(nodes))
+                self._maps[name] = cached
+        return cached[1]
+
+    def preload(self):
+        for code in ACT_INDEXES:
+            self.section_map(code)
+
+    def lookup(self, query: str):
+        # Only short questions that are about the cited sections themselves take the fast path
+        if not citations.has_citations(query):
+            return None
+        cited = citations.extract(query, acts=list(ACT_INDEXES) + MONGO_ACTS)
+        if not cited:
+            return None
+        extra = [token for token in tokenize(citations.remove(query)) if token not in STOPWORDS and not token.isdigit()]
+        if len(extra) > STATUTE_MAX_EXTRA_WORDS:
+            return None
+
+        found = []
+        for code, sections in cited.items():
+            for section in sections:
+                if code in ACT_INDEXES:
+                    match = self.section_map(code).get(section)
+                    if match is None:
+                        return None
+                    text, nodes = match
+                else:
+                    docs = section_index.find(code, [section])
+                    if not docs:
+                        return None
+                    text = "\n".join(str(doc.get('Description', '')) for doc in docs)
+                    nodes = [TextNode(text=text, metadata={"act": code, "section": section})]
+                found.append((code, section, text, nodes))
+        return found
+
+    def _context(self, found) -> str:
+        return "\n\n".join(f"{ACT_NAMES[code]}, section {section}:\n{text}" for code, section, text, _ in found)
+
+    def _response(self, found, summary: str) -> Response:
+        context = self._context(found)
+        source_nodes = [NodeWithScore(node=node, score=1.0) for _, _, _, nodes in found for node in nodes]
+        text = f"{summary.strip()}\n\n{context}" if summary else context
+        return Response(response=text, source_nodes=source_nodes, metadata={"fast_path": "statute"})
+
+    def answer(self, query: str):
+        found = self.lookup(query)
+        if not found:
+            return None
+        summary = ""
+        if STATUTE_SUMMARY:
+            summary = Settings.llm.complete(statute_template.format(sections=self._context(found), question=query)).text
+        return self._response(found, summary)
+
+    async def aanswer(self, query: str):
+        found = await run_blocking(self.lookup, query)
+        if not found:
+            return None
+        summary = ""
+        if STATUTE_SUMMARY:
+            prompt = statute_template.format(sections=self._context(found), question=query)
+            if streaming.active():
+                async for chunk in await Settings.llm.astream_complete(prompt):
+                    summary += chunk.delta or ""
+                    streaming.emit("token", chunk.delta or "")
+                streaming.emit("token", "\n\n" + self._context(found))
+            else:
+                summary = (await Settings.llm.acomplete(prompt)).text
+        elif streaming.active():
+            streaming.emit("token", self._context(found))
+        return self._response(found, summary)
+
+
+statute_lookup = StatuteLookup()
@@ -0,0 +1,116 @@
+import json
+import asyncio
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from fastapi.encoders import jsonable_encoder
+from langchain_core.callbacks import BaseCallbackHandler as LangChainCallbackHandler
+from llama_index.core import Settings
+from llama_index.core.base.response.schema import Response
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.callbacks.schema import CBEventType, EventPayload
+
+_stream = ContextVar("stream", default=None)
+
+DONE = object()
+
+
+def active() -> bool:
+    return _stream.get() is not None
+
+
+def emit(event: str, data: Any):
+    stream = _stream.get()
+    if stream is None:
+        return
+    loop, queue = stream
+    loop.call_soon_threadsafe(queue.put_nowait, (event, data))
+
+
+def sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+
+
+def _section(node) -> dict:
+    metadata = node.node.metadata
+    return {
+        "file_name": metadata.get("file_name"),
+        "page_label": metadata.get("page_label"),
+        "score": node.score,
+        "text": node.node.get_content()[:200],
+    }
+
+
+class LlamaIndexEvents(BaseCallbackHandler):
+    def __init__(self) -> None:
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+
+    def on_event_start(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None, event_id: str = "", parent_id: str = "", **kwargs: Any) -> str:
+        if active() and payload:
+            if event_type == CBEventType.SUB_QUESTION:
+                sub_q = payload[EventPayload.SUB_QUESTION].sub_q
+                emit("sub_question", {"tool": sub_q.tool_name, "question": sub_q.sub_question})
+            elif event_type == CBEventType.FUNCTION_CALL:
+                emit("tool", {"name": payload[EventPayload.TOOL].name, "input": payload[EventPayload.FUNCTION_CALL]})
+        return event_id
+
+    def on_event_end(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None, event_id: str = "", **kwargs: Any) -> None:
+        if active() and payload and event_type == CBEventType.RETRIEVE:
+            emit("sections", [_section(node) for node in payload.get(EventPayload.NODES, [])])
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(self, trace_id: Optional[str] = None, trace_map: Optional[Dict[str, List[str]]] = None) -> None:
+        pass
+
+
+class LangChainEvents(LangChainCallbackHandler):
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> None:
+        emit("tool", {"name": serialized.get("name"), "input": input_str})
+
+
+Settings.callback_manager.add_handler(LlamaIndexEvents())
+
+
+def stream_query(engine, query: str):
+    response = engine.query(query)
+    text = ""
+    for token in response.response_gen:
+        text += token
+        emit("token", token)
+    return Response(response=text, source_nodes=response.source_nodes, metadata=response.metadata)
+
+
+async def astream_query(engine, query: str):
+    response = await engine.aquery(query)
+    text = ""
+    async for token in response.async_response_gen():
+        text += token
+        emit("token", token)
+    return Response(response=text, source_nodes=response.source_nodes, metadata=response.metadata)
+
+
+async def event_stream(run):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    token = _stream.set((loop, queue))
+    try:
+        task = asyncio.ensure_future(run())
+    finally:
+        _stream.reset(token)
+    task.add_done_callback(lambda _: queue.put_nowait((DONE, None)))
+
+    try:
+        while True:
+            event, data = await queue.get()
+            if event is DONE:
+                break
+            yield sse(event, data)
+
+        try:
+            yield sse("done", task.result())
+        except Exception as e:
+            yield sse("error", {"error": str(e)})
+    finally:
+        task.cancel()
@@ -0,0 +1,311 @@
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# Share of requests whose info/debug logs and span breakdown are written, warnings always are
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.1))
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+UNTRACED_PATHS = {"/metrics", "/healthz", "/readyz"}
+
+_trace = ContextVar("trace", default=None)
+
+
+class Trace:
+    def __init__(self, name: str, sampled: bool = None) -> None:
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.sampled = random.random() < TRACE_SAMPLE_RATE if sampled is None else sampled
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def add(self, stage: str, start: float, duration: float, attrs: dict):
+        # Spans come from the event loop and from run_blocking threads, list.append is atomic
+        self.spans.append({"stage": stage, "start_ms": (start - self.started) * 1000, "duration_ms": duration * 1000, **attrs})
+
+    def summary(self) -> dict:
+        stages = {}
+        for span in self.spans:
+            stages[span["stage"]] = stages.get(span["stage"], 0.0) + span["duration_ms"]
+        return {"trace_id": self.id, "name": self.name, "duration_ms": (time.perf_counter() - self.started) * 1000, "stages": stages, "spans": self.spans}
+
+
+def current() -> Optional[Trace]:
+    return _trace.get()
+
+
+# ---- Logging ----
+
+class _Sampled(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        trace = getattr(record, "trace", None) or _trace.get()
+        record.trace_id = trace.id if trace else "-"
+        return record.levelno >= logging.WARNING or trace is None or trace.sampled
+
+
+def _configure_logging() -> logging.Logger:
+    logger = logging.getLogger("backend")
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    # Records are handed to a queue, the listener thread does the stdout writes
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    handler.addFilter(_Sampled())
+    logger.addHandler(handler)
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(trace_id)s] %(message)s"))
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+    atexit.register(listener.stop)
+    # Workers forked from a preloading master have no listener thread of their own
+    os.register_at_fork(after_in_child=listener.start)
+    return logger
+
+
+_root = _configure_logging()
+
+
+def get_logger(name: str) -> logging.Logger:
+    return _root.getChild(name)
+
+
+logger = get_logger("telemetry")
+
+
+# ---- Metrics ----
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{str(value)}"'.replace("\n", " ") for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = list(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                for bound, bucket in zip(self.buckets + ["+Inf"], counts + [count]):
+                    le = _labels(self.label_names, key, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{le} {bucket}")
+                lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {total}")
+                lines.append(f"{self.name}_count{_labels(self.label_names, key)} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels=()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            lines += [f"{self.name}{_labels(self.label_names, key)} {value}" for key, value in sorted(self._values.items())]
+        return lines
+
+
+class Callback:
+    # Read at scrape time from the stats the services already keep
+    def __init__(self, name: str, help: str, kind: str, read, labels=()) -> None:
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.read = read
+        self.label_names = tuple(labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.read()
+        except Exception as e:
+            logger.warning("metric %s failed: %s", self.name, e)
+            return []
+        if isinstance(value, dict):
+            lines += [f"{self.name}{_labels(self.label_names, key if isinstance(key, tuple) else (key,))} {v}" for key, v in value.items()]
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def histogram(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def counter(self, name: str, help: str, labels=()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, read, labels=(), kind: str = "gauge"):
+        # kind="counter" for totals the services count themselves
+        with self._lock:
+            self._metrics[name] = Callback(name, help, kind, read, labels)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+stage_seconds = metrics.histogram("stage_duration_seconds", "Time spent per pipeline stage", ["stage"])
+http_seconds = metrics.histogram("http_request_duration_seconds", "Request latency until the last body chunk", ["app", "method", "route", "status"])
+llm_seconds = metrics.histogram("llm_request_duration_seconds", "LLM call latency", ["model"])
+llm_tokens = metrics.counter("llm_tokens_total", "LLM tokens by model and direction", ["model", "kind"])
+mongo_seconds = metrics.histogram("mongo_command_duration_seconds", "MongoDB command latency", ["command"])
+errors_total = metrics.counter("stage_errors_total", "Failed pipeline stages", ["stage"])
+
+
+# ---- Spans ----
+
+def record(stage: str, start: float, duration: float, **attrs):
+    stage_seconds.observe(duration, stage=stage)
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(stage, start, duration, attrs)
+
+
+@contextmanager
+def span(stage: str, **attrs):
+    start = time.perf_counter()
+    try:
+        yield attrs
+    except BaseException:
+        errors_total.inc(stage=stage)
+        attrs["error"] = True
+        raise
+    finally:
+        record(stage, start, time.perf_counter() - start, **attrs)
+
+
+def llm_call(model: str, start: float, duration: float, prompt_tokens: int = None, completion_tokens: int = None, stage: str = "llm"):
+    llm_seconds.observe(duration, model=model)
+    if prompt_tokens:
+        llm_tokens.inc(prompt_tokens, model=model, kind="prompt")
+    if completion_tokens:
+        llm_tokens.inc(completion_tokens, model=model, kind="completion")
+    record(stage, start, duration, model=model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+
+def usage(response) -> Dict[str, Any]:
+    # llama_index OpenAI responses carry the counts in additional_kwargs, raw has the API usage block
+    counts = dict(getattr(response, "additional_kwargs", None) or {})
+    if "prompt_tokens" in counts:
+        return counts
+    raw = getattr(response, "raw", None)
+    usage = raw.get("usage") if isinstance(raw, dict) else getattr(raw, "usage", None)
+    if usage is None:
+        return {}
+    if not isinstance(usage, dict):
+        usage = {"prompt_tokens": getattr(usage, "prompt_tokens", None), "completion_tokens": getattr(usage, "completion_tokens", None)}
+    return usage
+
+
+# ---- Request tracing ----
+
+def finish(trace: Trace, app: str, method: str, route: str, status: int):
+    duration = time.perf_counter() - trace.started
+    http_seconds.observe(duration, app=app, method=method, route=route, status=status)
+    if trace.sampled:
+        logger.info("%s", json.dumps({**trace.summary(), "status": status}), extra={"trace": trace})
+
+
+def _route(request) -> str:
+    # Path parameters go back to placeholders so the route label stays bounded
+    if "route" not in request.scope:
+        return "unmatched"
+    path = request.url.path
+    for name, value in request.scope.get("path_params", {}).items():
+        path = path.replace(f"/{value}", f"/{{{name}}}", 1)
+    return path
+
+
+def instrument(app, name: str):
+    # Adds request tracing middleware and the /metrics endpoint to a FastAPI app
+    from fastapi.responses import Response
+
+    @app.middleware("http")
+    async def trace_requests(request, call_next):
+        if request.url.path in UNTRACED_PATHS:
+            return await call_next(request)
+        trace = Trace(f"{request.method} {request.url.path}")
+        token = _trace.set(trace)
+        try:
+            response = await call_next(request)
+        except Exception:
+            finish(trace, name, request.method, _route(request), 500)
+            raise
+        finally:
+            _trace.reset(token)
+
+        route = _route(request)
+        response.headers["X-Trace-Id"] = trace.id
+        body = response.body_iterator
+
+        async def traced_body():
+            # Streaming responses are timed until their last event, not their headers
+            try:
+                async for chunk in body:
+                    yield chunk
+            finally:
+                finish(trace, name, request.method, route, response.status_code)
+
+        response.body_iterator = traced_body()
+        return response
+
+    @app.get("/metrics", include_in_schema=False)
+    def prometheus_metrics():
+        return Response(metrics.render(), media_type=CONTENT_TYPE)
@@ -29,4 +29,15 @@ identify the relevant variables and execute.
 Begin generating document! Remember to be ethical, legal and articulate when giving your final answer. Use lots of arguments.
 
 Question: {input}
-{agent_scratchpad}"""
\ No newline at end of file
+{agent_scratchpad}"""
+
+statute_template = """You are a legal professional with experience of more than 30 years. Answer the question in at most 
+five plain sentences using only the sections quoted below. Think from the point of view 
+of Indian Legal System. Do not quote the sections again, they are shown to the user 
+after your answer.
+
+Sections:
+{sections}
+
+Question: {question}
+Answer:"""
@@ -0,0 +1,31 @@
+import pytest
+
+import citations
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("section 302 IPC", {"IPC": ["302"]}),
+    ("u/s 41A Cr.P.C.", {"CrPC": ["41A"]}),
+    ("sections 302, 307 and 34 of the Indian Penal Code", {"IPC": ["302", "307", "34"]}),
+    ("302/34 IPC r/w 120B", {"IPC": ["302", "34", "120B"]}),
+    ("376(2)(n) IPC", {"IPC": ["376"]}),
+    ("section 66(1)(iv) IPC", {"IPC": ["66"]}),
+    ("section 304(B) IPC", {"IPC": ["304B"]}),
+    ("304-B IPC", {"IPC": ["304B"]}),
+    ("Sec. 498-A IPC", {"IPC": ["498A"]}),
+    ("sec 41-A CrPC", {"CrPC": ["41A"]}),
+    ("IPC 302", {"IPC": ["302"]}),
+    ("IPC section 302", {"IPC": ["302"]}),
+    ("Indian Penal Code, 1860 sections 34 and 120B", {"IPC": ["34", "120B"]}),
+])
+def test_extract(text, expected):
+    assert citations.extract(text) == expected
+
+
+def test_extract_ignores_bare_year():
+    assert citations.extract("IPC 1860") == {}
+
+
+def test_fingerprint_tells_sections_apart():
+    assert citations.fingerprint("section 184 MVA") != citations.fingerprint("section 185 MVA")
+    assert citations.fingerprint("section 184 MVA") == citations.fingerprint("sec 184 of the MVA")
@@ -0,0 +1,105 @@
+import time
+from typing import Any, Dict, List, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler as LangChainCallbackHandler
+from llama_index.core import Settings
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.callbacks.schema import CBEventType, EventPayload
+
+import telemetry
+
+logger = telemetry.get_logger("agents")
+
+STAGES = {
+    CBEventType.EMBEDDING: "embedding",
+    CBEventType.RETRIEVE: "retrieval",
+    CBEventType.LLM: "llm",
+    CBEventType.SYNTHESIZE: "synthesize",
+    CBEventType.SUB_QUESTION: "sub_question",
+    CBEventType.FUNCTION_CALL: "tool",
+}
+
+
+class LlamaIndexTrace(BaseCallbackHandler):
+    def __init__(self) -> None:
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self._started = {}
+
+    def on_event_start(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None, event_id: str = "", parent_id: str = "", **kwargs: Any) -> str:
+        if event_type not in STAGES:
+            return event_id
+        model = None
+        if event_type == CBEventType.LLM and payload:
+            serialized = payload.get(EventPayload.SERIALIZED) or {}
+            model = serialized.get("model") or serialized.get("class_name")
+        elif event_type == CBEventType.FUNCTION_CALL and payload:
+            logger.debug("tool %s: %s", payload[EventPayload.TOOL].name, payload[EventPayload.FUNCTION_CALL])
+        self._started[event_id] = (time.perf_counter(), model)
+        return event_id
+
+    def on_event_end(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None, event_id: str = "", **kwargs: Any) -> None:
+        started = self._started.pop(event_id, None)
+        if started is None:
+            return
+        start, model = started
+        duration = time.perf_counter() - start
+        payload = payload or {}
+        if event_type == CBEventType.LLM:
+            usage = telemetry.usage(payload.get(EventPayload.RESPONSE) or payload.get(EventPayload.COMPLETION))
+            telemetry.llm_call(model or "unknown", start, duration, usage.get("prompt_tokens"), usage.get("completion_tokens"))
+        elif event_type == CBEventType.RETRIEVE:
+            telemetry.record("retrieval", start, duration, nodes=len(payload.get(EventPayload.NODES) or []))
+        else:
+            telemetry.record(STAGES[event_type], start, duration)
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(self, trace_id: Optional[str] = None, trace_map: Optional[Dict[str, List[str]]] = None) -> None:
+        pass
+
+
+class LangChainTrace(LangChainCallbackHandler):
+    # Times the ReAct agent's own LLM calls and logs its steps in place of verbose=True
+    run_inline = True
+
+    def __init__(self) -> None:
+        self._started = {}
+
+    def _start(self, serialized: Dict[str, Any], run_id, kwargs):
+        params = kwargs.get("invocation_params") or {}
+        model = params.get("model") or params.get("model_name") or (serialized or {}).get("name")
+        self._started[run_id] = (time.perf_counter(), model)
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id, **kwargs: Any) -> None:
+        self._start(serialized, run_id, kwargs)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages, *, run_id, **kwargs: Any) -> None:
+        self._start(serialized, run_id, kwargs)
+
+    def on_llm_end(self, response, *, run_id, **kwargs: Any) -> None:
+        started = self._started.pop(run_id, None)
+        if started is None:
+            return
+        start, model = started
+        output = response.llm_output or {}
+        usage = output.get("token_usage") or {}
+        telemetry.llm_call(output.get("model_name") or model or "unknown", start, time.perf_counter() - start, usage.get("prompt_tokens"), usage.get("completion_tokens"), stage="agent_llm")
+
+    def on_llm_error(self, error: BaseException, *, run_id, **kwargs: Any) -> None:
+        if self._started.pop(run_id, None) is not None:
+            telemetry.errors_total.inc(stage="agent_llm")
+        logger.warning("agent llm failed: %s", error)
+
+    def on_agent_action(self, action, **kwargs: Any) -> None:
+        logger.debug("agent action %s: %s", action.tool, action.tool_input)
+
+    def on_agent_finish(self, finish, **kwargs: Any) -> None:
+        logger.debug("agent finished: %s", str(finish.return_values.get("output"))[:200])
+
+
+def agent_config(*handlers) -> dict:
+    return {"callbacks": [LangChainTrace(), *handlers]}
+
+
+Settings.callback_manager.add_handler(LlamaIndexTrace())
@@ -4,6 +4,8 @@ from llama_index.core import Settings
 from dotenv import load_dotenv
 import os
 
+from embed_cache import CachedEmbedding
+
 load_dotenv()
 
 # AzureOpenAIEmbeddings
@@ -19,6 +21,8 @@ embed_model = AzureOpenAIEmbedding(
     api_version=api_version,
 )
 
+embed_model = CachedEmbedding(embed_model)
+
 Settings.embed_model = embed_model
 
 # AzureOpenAI